@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2010-2013 by Pablo Martín <goinnn@gmail.com>
+#
+# This software is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This software is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this software.  If not, see <http://www.gnu.org/licenses/>.
+
+import sqlite3
+
+from django.conf import settings
+from django.template.base import TemplateDoesNotExist
+from django.template.loader import BaseLoader
+
+
+class Loader(BaseLoader):
+    """
+    Reference loader of the templates of a SQLite database (the table
+    template, with the columns name and content, of the SQLITE_TEMPLATES
+    setting) that implements the batch protocol of smartextends:
+    load_template_sources returns the templates of many names with a query.
+    It counts its queries.
+    """
+    is_usable = True
+
+    def __init__(self, *args, **kwargs):
+        super(Loader, self).__init__(*args, **kwargs)
+        self.queries = 0
+
+    def get_display_name(self, template_name):
+        return 'sqlite:%s:%s' % (settings.SQLITE_TEMPLATES, template_name)
+
+    def query(self, sql, params=()):
+        self.queries += 1
+        connection = sqlite3.connect(settings.SQLITE_TEMPLATES)
+        try:
+            return connection.execute(sql, params).fetchall()
+        finally:
+            connection.close()
+
+    def get_template_names(self):
+        return [name for name, in self.query('SELECT name FROM template')]
+
+    def load_template_source(self, template_name, template_dirs=None):
+        rows = self.query('SELECT content FROM template WHERE name = ?', (template_name,))
+        if not rows:
+            raise TemplateDoesNotExist(template_name)
+        return (rows[0][0], self.get_display_name(template_name))
+
+    def load_template_sources(self, template_names, template_dirs=None):
+        rows = self.query('SELECT name, content FROM template WHERE name IN (%s)' %
+                          ', '.join(['?'] * len(template_names)), list(template_names))
+        return dict((name, (content, self.get_display_name(name))) for name, content in rows)
@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2010-2013 by Pablo Martín <goinnn@gmail.com>
+#
+# This software is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This software is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this software.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+
+from django.conf import settings
+from django.template.loaders.filesystem import Loader as FileSystemLoader
+
+LEVELS = 6
+
+lookups = {'count': 0}
+
+
+class LevelLoader(FileSystemLoader):
+    """
+    Filesystem loader of the directory LEVEL_TEMPLATE_DIRS[level] (a setting
+    of the tests and the benchmarks) that counts its lookups
+    """
+    level = None
+
+    def get_template_sources(self, template_name, template_dirs=None):
+        template_dir = settings.LEVEL_TEMPLATE_DIRS[self.level]
+        return super(LevelLoader, self).get_template_sources(template_name, (template_dir,))
+
+    def load_template_source(self, template_name, template_dirs=None):
+        lookups['count'] += 1
+        return super(LevelLoader, self).load_template_source(template_name, template_dirs)
+
+
+# smart_extends skips the loaders by class, so every level needs its own class
+LEVEL_LOADERS = []
+for i in range(LEVELS):
+    level_loader = type(str('Level%dLoader' % i), (LevelLoader,), {'level': i})
+    globals()[level_loader.__name__] = level_loader
+    LEVEL_LOADERS.append(level_loader)
+
+
+def get_level_loader_names(levels):
+    return ['%s.%s' % (__name__, level_loader.__name__) for level_loader in LEVEL_LOADERS[:levels]]
+
+
+def write_level_template(level, name, content):
+    path = os.path.join(settings.LEVEL_TEMPLATE_DIRS[level], *name.split('/'))
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path, 'w') as template_file:
+        template_file.write(content)
+
+
+def get_admin_context():
+    "The context of the change_form template of the admin site"
+    from django.contrib.auth.models import Group
+    return {'opts': Group._meta, 'app_label': 'auth', 'original': Group(pk=1, name='group'),
+            'object_id': 1, 'change': True, 'add': False, 'is_popup': False, 'save_as': False,
+            'has_add_permission': False, 'has_change_permission': True,
+            'has_delete_permission': False, 'show_delete': False, 'csrf_token': 'token'}
@@ -14,6 +14,11 @@
 # You should have received a copy of the GNU Lesser General Public License
 # along with this software.  If not, see <http://www.gnu.org/licenses/>.
 import logging
+import os
+import shutil
+import tempfile
+
+from os import path
 
 from django.conf import settings
 from django.contrib.auth.models import User
@@ -22,8 +27,12 @@ from django.template.base import TemplateSyntaxError, TemplateDoesNotExist
 from django.template.loader_tags import do_extends
 from django.test import TestCase
 from django.test.client import Client
+from django.test.utils import override_settings
+from django.utils.unittest import skipIf
+
+from smartextends.templatetags.smart_extends_tags import SmartExtendsNode, do_smart_extends, register
 
-from smartextends.templatetags.smart_extends_tags import do_smart_extends, register
+from example.app.test_helpers import LEVELS, get_level_loader_names, lookups, write_level_template
 
 logging.basicConfig()
 logger = logging.getLogger('test.app')
@@ -38,7 +47,36 @@ if not INSTALLED_DB_TEMPLATES:
 class SmartExtendsCase(TestCase):
 
     def setUp(self):
+        from django.template import loader
         self.client = Client(enforce_csrf_checks=False)
+        self.template_loaders = settings.TEMPLATE_LOADERS
+        self.template_source_loaders = loader.template_source_loaders
+        # The templates of the loaders of test_helpers, a directory for each level
+        self.template_root = tempfile.mkdtemp()
+        self.level_settings = override_settings(LEVEL_TEMPLATE_DIRS=[path.join(self.template_root, str(i))
+                                                                     for i in range(LEVELS)])
+        self.level_settings.enable()
+        lookups['count'] = 0
+
+    def tearDown(self):
+        from django.template import loader
+        from smartextends.block_cache import reset_block_cache
+        from smartextends.loader import invalidate_parent_cache, reset_miss_cache
+        self.level_settings.disable()
+        shutil.rmtree(self.template_root)
+        settings.TEMPLATE_LOADERS = self.template_loaders
+        loader.template_source_loaders = self.template_source_loaders
+        reset_block_cache()
+        reset_miss_cache()
+        invalidate_parent_cache()
+
+    def set_level_loaders(self, levels):
+        "Uses a smartextends cached loader of the first levels of test_helpers"
+        from django.template import loader
+        from smartextends.loaders.cached import Loader
+        cached_loader = Loader(get_level_loader_names(levels))
+        loader.template_source_loaders = (cached_loader,)
+        return cached_loader
 
     def __client_login(self):
         client = self.client
@@ -135,7 +173,7 @@ class SmartExtendsCase(TestCase):
         self.check_url(client, url)
         register.tag('extends', do_extends)
         if INSTALLED_DB_TEMPLATES:
-            template.content = template.content.replace('smart_extends', 'extends')
+            template.content = template.content.replace('{% extends', '{% smart_extends')
             template.save()
 
     def test_smart_extends_check_old_template_loaders(self):
@@ -183,3 +221,793 @@ class SmartExtendsCase(TestCase):
         template.content = template.content.replace('{% smart_extends "admin/change_form2.html" %}',
                                                     '{% smart_extends "admin/change_form.html" %}')
         template.save()
+
+    def test_smart_extends_override_index(self):
+        from django.template import loader
+        from smartextends.loader import OverrideIndex, get_template_source_loaders
+        loader.template_source_loaders = None
+        loaders = get_template_source_loaders()
+        index = OverrideIndex()
+        self.assertEqual(index.get_loaders(loaders, loaders[0].load_template_source), loaders[1:])
+        self.assertEqual(index.get_loaders(loaders, loaders[-1].load_template_source), ())
+        self.assertEqual(index.get_loaders(loaders, None), ())
+        loader.template_source_loaders = None
+        new_loaders = get_template_source_loaders()
+        self.assertEqual(index.get_loaders(new_loaders, new_loaders[0].load_template_source), new_loaders[1:])
+        self.assertTrue(index._index[0] is new_loaders)
+
+    def test_smart_extends_miss_cache(self):
+        from smartextends import loader as smart_loader
+        with override_settings(SMART_EXTENDS_MISS_CACHE_SIZE=100):
+            smart_loader.reset_miss_cache()
+            name = 'admin/not_exists.html'
+            loaders = smart_loader.get_template_source_loaders()
+            self.assertRaises(TemplateDoesNotExist, smart_loader.find_template, name)
+            miss_cache = smart_loader.get_miss_cache()
+            self.assertEqual(len(miss_cache), len(loaders))
+            self.assertRaises(TemplateDoesNotExist, smart_loader.find_template, name)
+            self.assertEqual(len(miss_cache), len(loaders))
+            smart_loader.invalidate_miss_cache(name)
+            self.assertEqual(len(miss_cache), 0)
+        smart_loader.reset_miss_cache()
+        self.assertEqual(smart_loader.get_miss_cache().max_entries, 0)
+
+    def test_smart_extends_cached_loader_lru(self):
+        from smartextends.loaders.cached import Loader
+        with override_settings(SMART_EXTENDS_CACHE_MAX_ENTRIES=1):
+            cached_loader = Loader(settings.TEMPLATE_LOADERS)
+        template, origin = cached_loader('admin/base.html')
+        self.assertTrue(cached_loader('admin/base.html')[0] is template)
+        cached_loader('admin/login.html')
+        stats = cached_loader.template_cache.stats()
+        self.assertEqual(stats['entries'], 1)
+        self.assertEqual((stats['hits'], stats['misses'], stats['evictions']), (1, 2, 1))
+        self.assertTrue(stats['size'] > 0)
+        cached_loader.reset()
+        self.assertEqual(cached_loader.template_cache.stats()['size'], 0)
+        # The origins, the dependencies and the files of the discarded templates are forgotten
+        for i in range(5):
+            write_level_template(0, 'lru/page%d.html' % i, '{%% extends "lru/base.html" %%}%d' % i)
+        with override_settings(SMART_EXTENDS_CACHE_MAX_ENTRIES=2, SMART_EXTENDS_REVALIDATE_INTERVAL=0):
+            cached_loader = Loader(get_level_loader_names(1))
+        for i in range(5):
+            cached_loader('lru/page%d.html' % i)
+        self.assertEqual(sorted(cached_loader.origins), sorted(cached_loader.template_cache))
+        self.assertEqual(sorted(cached_loader.file_stats), sorted(cached_loader.template_cache))
+        self.assertEqual(len(cached_loader.file_checks), 2)
+        self.assertEqual(sorted(cached_loader.dependents), ['lru/base.html', 'lru/page3.html', 'lru/page4.html'])
+        self.assertEqual(len(cached_loader.dependents['lru/base.html']), 2)
+
+    def test_smart_extends_cached_loader_single_flight(self):
+        import threading
+        import time
+        from smartextends.loaders.cached import Loader
+        # The threads can not use the test database (dbtemplates)
+        cached_loader = Loader(('django.template.loaders.filesystem.Loader',
+                                'django.template.loaders.app_directories.Loader'))
+        compile_template = cached_loader.compile_template
+        calls = []
+
+        def slow_compile_template(*args, **kwargs):
+            calls.append(args)
+            time.sleep(0.1)
+            return compile_template(*args, **kwargs)
+        cached_loader.compile_template = slow_compile_template
+        templates = []
+        threads = [threading.Thread(target=lambda: templates.append(cached_loader('admin/base.html')[0]))
+                   for i in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(len(templates), 5)
+        self.assertEqual(len(set([id(template) for template in templates])), 1)
+        self.assertEqual(cached_loader.compile_locks, {})
+
+    def test_smart_extends_cached_loader_keys(self):
+        from django.template import loader
+        from django.template.loaders.app_directories import Loader as AppDirectoriesLoader
+        from django.template.loaders.filesystem import Loader as FileSystemLoader
+        client = self.__client_login()
+        user_pk = client.session.get('_auth_user_id')
+        self.add_cache_template()
+        try:
+            self.check_url(client, reverse('admin:auth_user_change', args=(user_pk,)))
+            cached_loader = loader.template_source_loaders[0]
+            keys = list(cached_loader.template_cache)
+            self.assertTrue(('admin/change_form.html', None, None) in keys)
+            self.assertTrue(('admin/change_form.html', None, FileSystemLoader) in keys)
+            self.assertFalse(('admin/change_form.html', None, AppDirectoriesLoader) in keys)
+            for name, dirs_key, skip_key in keys:
+                self.assertFalse(hasattr(name, 'skip_template'))
+        finally:
+            self.remove_cache_template()
+
+    def test_smart_extends_cached_loader_dirs(self):
+        from smartextends.loaders.cached import Loader
+        cached_loader = Loader(settings.TEMPLATE_LOADERS)
+        template_dirs = [path.join(settings.BASEDIR, 'templates')]
+        template, origin = cached_loader('admin/change_form.html', template_dirs)
+        self.assertEqual(len(cached_loader.dirs_keys), 1)
+        self.assertTrue(cached_loader('admin/change_form.html', tuple(template_dirs))[0] is template)
+        self.assertEqual(len(cached_loader.dirs_keys), 1)
+        self.assertEqual(cached_loader.template_cache.stats()['hits'], 1)
+
+    def test_smart_extends_flatten(self):
+        from django.template import loader
+        client = self.__client_login()
+        user_pk = client.session.get('_auth_user_id')
+        url = reverse('admin:auth_user_change', args=(user_pk,))
+        content = client.get(url).content
+        with override_settings(SMART_EXTENDS_FLATTEN=True):
+            self.assertEqual(client.get(url).content, content)
+            self.add_cache_template()
+            try:
+                self.check_url(client, url)
+                cached_loader = loader.template_source_loaders[0]
+                template = cached_loader.template_cache.peek(('admin/change_form.html', None, None))
+                node = template.nodelist[0]
+                self.assertTrue(node.flatten)
+                generation, root, blocks = node.flattened
+                self.assertEqual(root.nodelist.get_nodes_by_type(SmartExtendsNode), [])
+                self.assertTrue(len(blocks['content_title']) > 1)
+                self.assertEqual(client.get(url).content, content)
+            finally:
+                self.remove_cache_template()
+            # A chain that loops is an error, not an endless loop
+            from django.template import Context
+            from smartextends.templatetags.smart_extends_tags import ExtendsRecursionError
+            write_level_template(0, 'loop/page.html', '{% smart_extends "loop/a.html" %}')
+            write_level_template(0, 'loop/a.html', '{% extends "loop/b.html" %}')
+            write_level_template(0, 'loop/b.html', '{% extends "loop/a.html" %}')
+            self.set_level_loaders(1)
+            template = loader.get_template('loop/page.html')
+            self.assertRaises(ExtendsRecursionError, template.render, Context())
+
+    def test_smart_extends_cache_parents(self):
+        from smartextends import loader as smart_loader
+        client = self.__client_login()
+        user_pk = client.session.get('_auth_user_id')
+        url = reverse('admin:auth_user_change', args=(user_pk,))
+        smart_loader.invalidate_parent_cache()
+        parent_cache = smart_loader.get_parent_cache()
+        with override_settings(SMART_EXTENDS_CACHE_PARENTS=True):
+            self.check_url(client, url)
+            entries = len(parent_cache)
+            self.assertTrue(entries > 0)
+            hits = parent_cache.hits
+            self.check_url(client, url)
+            self.assertEqual(len(parent_cache), entries)
+            self.assertTrue(parent_cache.hits > hits)
+            generation = smart_loader.get_parent_cache_generation()
+            smart_loader.invalidate_parent_cache('admin/change_form.html')
+            self.assertEqual(len(parent_cache), 0)
+            self.assertEqual(smart_loader.get_parent_cache_generation(), generation + 1)
+            self.check_url(client, url)
+        smart_loader.invalidate_parent_cache()
+
+    def test_smart_extends_warm_template_cache(self):
+        from django.core.management import call_command
+        from django.template import loader
+        from django.template.loaders.filesystem import Loader as FileSystemLoader
+        from django.utils.six import StringIO
+        from smartextends.templatetags.smart_extends_tags import ExtendsRecursionError
+        from smartextends.warmup import get_template_names, warm_template_cache
+        names = get_template_names()
+        self.assertTrue('admin/change_form.html' in names)
+        self.assertTrue('admin/base_site.html' in names)
+        self.add_cache_template()
+        try:
+            loaded, errors = warm_template_cache(['admin/change_form.html', 'admin/not_exists.html'])
+            self.assertEqual(loaded, ['admin/change_form.html'])
+            self.assertEqual(list(errors.keys()), ['admin/not_exists.html'])
+            keys = list(loader.template_source_loaders[0].template_cache)
+            self.assertTrue(('admin/change_form.html', None, FileSystemLoader) in keys)
+            self.assertTrue(('admin/base.html', None, None) in keys)
+            stdout = StringIO()
+            call_command('warm_smart_extends_cache', 'admin/change_list.html', stdout=stdout)
+            self.assertTrue('Loaded 1 templates (0 errors)' in stdout.getvalue())
+            write_level_template(0, 'recursive/page.html', '{% extends "recursive/parent.html" %}')
+            write_level_template(0, 'recursive/parent.html', '{% extends "recursive/page.html" %}')
+            self.set_level_loaders(1)
+            loaded, errors = warm_template_cache(['recursive/page.html'])
+            self.assertTrue(isinstance(errors['recursive/page.html'], ExtendsRecursionError))
+            write_level_template(0, 'recursive/smart.html', '{% smart_extends "recursive/other.html" %}')
+            write_level_template(0, 'recursive/other.html', '{% smart_extends "recursive/smart.html" %}')
+            self.set_level_loaders(1)
+            loaded, errors = warm_template_cache(['recursive/smart.html'])
+            self.assertTrue(isinstance(errors['recursive/smart.html'], ExtendsRecursionError))
+            # A file that can not be decoded is an error of its name only
+            with open(path.join(settings.LEVEL_TEMPLATE_DIRS[0], 'recursive', 'bad.html'), 'wb') as bad_file:
+                bad_file.write(b'\xff\xfe\xfa')
+            write_level_template(0, 'good.html', 'good')
+            self.set_level_loaders(1)
+            loaded, errors = warm_template_cache(['recursive/bad.html', 'good.html'])
+            self.assertEqual(loaded, ['good.html'])
+            self.assertEqual(list(errors.keys()), ['recursive/bad.html'])
+            self.assertTrue(isinstance(errors['recursive/bad.html'], UnicodeDecodeError))
+        finally:
+            self.remove_cache_template()
+
+    def test_smart_extends_invalidate_template(self):
+        from django.template import loader
+        from django.template.loaders.filesystem import Loader as FileSystemLoader
+        from smartextends.loader import invalidate_template
+        client = self.__client_login()
+        user_pk = client.session.get('_auth_user_id')
+        url = reverse('admin:auth_user_change', args=(user_pk,))
+        self.add_cache_template()
+        try:
+            self.check_url(client, url)
+            cached_loader = loader.template_source_loaders[0]
+            keys = list(cached_loader.template_cache)
+            self.assertTrue(('admin/change_form.html', None, FileSystemLoader) in keys)
+            invalidated = cached_loader.invalidate('admin/base_site.html')
+            self.assertTrue('admin/change_form.html' in invalidated)
+            keys = list(cached_loader.template_cache)
+            self.assertFalse(('admin/change_form.html', None, None) in keys)
+            self.assertFalse(('admin/change_form.html', None, FileSystemLoader) in keys)
+            self.assertFalse(('admin/base_site.html', None, None) in keys)
+            self.assertTrue(('admin/base.html', None, None) in keys)
+            self.check_url(client, url)
+            with override_settings(SMART_EXTENDS_INVALIDATION_MODELS=(('dbtemplates.Template', 'name'),)):
+                self.modify_template_and_check(client, url, has_error=True)
+            self.check_url(client, url)
+            self.modify_template_and_check(client, url, has_error=False)
+            invalidate_template('admin/change_form.html')
+            self.check_url(client, url)
+        finally:
+            self.remove_cache_template()
+
+    def test_smart_extends_revalidate_files(self):
+        from django.template import Context
+        from smartextends.loaders.cached import Loader
+        template_dir = tempfile.mkdtemp()
+        template_path = path.join(template_dir, 'page.html')
+
+        def write_template(content):
+            with open(template_path, 'w') as template_file:
+                template_file.write(content)
+        try:
+            write_template('one')
+            with override_settings(SMART_EXTENDS_REVALIDATE_INTERVAL=0, TEMPLATE_DIRS=(template_dir,)):
+                cached_loader = Loader(('django.template.loaders.filesystem.Loader',))
+                self.assertEqual(cached_loader('page.html')[0].render(Context()), 'one')
+                write_template('two!')
+                self.assertEqual(cached_loader('page.html')[0].render(Context()), 'two!')
+                cached_loader.revalidate_interval = 3600
+                write_template('three')
+                self.assertEqual(cached_loader('page.html')[0].render(Context()), 'two!')
+        finally:
+            shutil.rmtree(template_dir)
+
+        # The nodes of the flattened chain keep the parents, their files are revalidated too
+        from django.template import loader
+        write_level_template(0, 'revalidate/page.html',
+                             '{% smart_extends "revalidate/page.html" %}{% block body %}<{{ block.super }}>{% endblock %}')
+        write_level_template(1, 'revalidate/page.html', '{% extends "revalidate/base.html" %}')
+        write_level_template(1, 'revalidate/base.html', '{% block body %}base{% endblock %}')
+        with override_settings(SMART_EXTENDS_REVALIDATE_INTERVAL=0, SMART_EXTENDS_FLATTEN=True,
+                               SMART_EXTENDS_CACHE_PARENTS=True):
+            self.set_level_loaders(2)
+            self.assertEqual(loader.get_template('revalidate/page.html').render(Context()), '<base>')
+            write_level_template(1, 'revalidate/base.html', '{% block body %}new base{% endblock %}')
+            self.assertEqual(loader.get_template('revalidate/page.html').render(Context()), '<new base>')
+
+    def test_smart_extends_benchmarks(self):
+        from django.conf import settings
+        from example.benchmarks import format_rows, resource, run_benchmarks
+        from smartextends.loader import lexer_sets_source
+        rows = run_benchmarks(iterations=1, max_loaders=3)
+        lookups = dict(((scenario, levels, cached), row_lookups)
+                       for scenario, levels, cached, elapsed, row_lookups, peak in rows)
+        peaks = dict(((scenario, levels, cached), peak)
+                     for scenario, levels, cached, elapsed, row_lookups, peak in rows)
+        self.assertEqual(lookups[('extends', 3, False)], 6)
+        self.assertEqual(lookups[('extends', 3, True)], 0)
+        if settings.TEMPLATE_DEBUG or lexer_sets_source():
+            self.assertEqual(lookups[('smart_extends', 3, False)], 3)
+            self.assertEqual(lookups[('smart_extends', 3, True)], 0)
+        self.assertTrue('ms/render' in format_rows(rows))
+        if resource is not None:
+            self.assertTrue(all(peak is not None for peak in peaks.values()))
+
+    def test_smart_extends_stats(self):
+        from django.template.loader import LoaderOrigin
+        from smartextends import loader as smart_loader
+        from smartextends.loaders.cached import Loader
+        from smartextends.stats import Statistics, register_hook, unregister_hook
+        events = []
+        statistics = Statistics()
+        register_hook(events.append)
+        register_hook(statistics)
+        try:
+            name = 'admin/change_form.html'
+            loaders = smart_loader.get_template_source_loaders()
+            skip_template = LoaderOrigin(name, loaders[0].load_template_source, name, None)
+            smart_loader.find_template(name, skip_template=skip_template)
+            event = events[-1]
+            self.assertEqual(event['source'], 'find_template')
+            self.assertEqual(event['skipped'], [smart_loader.get_loader_key(loaders[0])])
+            self.assertEqual(event['found'], event['tried'][-1])
+            self.assertEqual(event['misses'], len(event['tried']) - 1)
+            self.assertRaises(TemplateDoesNotExist, smart_loader.find_template, 'admin/not_exists.html')
+            self.assertEqual(events[-1]['found'], None)
+            self.assertEqual(events[-1]['misses'], len(loaders))
+            cached_loader = Loader(('django.template.loaders.filesystem.Loader',
+                                    'django.template.loaders.app_directories.Loader'))
+            cached_loader('admin/base.html')
+            cached_loader('admin/base.html')
+            self.assertEqual([event['cache'] for event in events[-2:]], ['miss', 'hit'])
+            counters = statistics.get_stats('cached_loader')[('cached_loader', 'admin/base.html')]
+            self.assertEqual((counters['count'], counters['cache_hits'], counters['cache_misses']), (2, 1, 1))
+            self.assertEqual(counters['misses'], 1)
+            self.assertEqual(sum(counters['histogram']), 2)
+            self.assertEqual(len(statistics.top(2)), 2)
+            statistics.reset()
+            self.assertEqual(statistics.get_stats(), {})
+        finally:
+            unregister_hook(events.append)
+            unregister_hook(statistics)
+
+    def test_smart_extends_profile_middleware(self):
+        from smartextends import stats
+        from smartextends.middleware import record_event
+        middleware = settings.MIDDLEWARE_CLASSES + ('smartextends.middleware.ProfileMiddleware',)
+        try:
+            with override_settings(MIDDLEWARE_CLASSES=middleware):
+                client = Client()
+                client.login(username='admin', password='testtest')
+                user_pk = client.session.get('_auth_user_id')
+                response = client.get(reverse('admin:auth_user_change', args=(user_pk,)))
+                profile = dict(item.split('=') for item in response['X-Smart-Extends-Profile'].split('; '))
+                self.assertTrue(int(profile['resolutions']) > 0)
+                self.assertTrue(int(profile['smart_extends']) > 0)
+                self.assertTrue(int(profile['loader_calls']) >= int(profile['resolutions']))
+                self.assertTrue(profile['time'].endswith('ms'))
+                with override_settings(SMART_EXTENDS_PROFILE_HEADER=None):
+                    response = client.get(reverse('admin:auth_user_change', args=(user_pk,)))
+                    self.assertFalse(response.has_header('X-Smart-Extends-Profile'))
+        finally:
+            stats.unregister_hook(record_event)
+
+    def test_smart_extends_indexed_loaders(self):
+        from django.template import loader
+        from smartextends.loaders.filesystem import Loader
+        template_dirs = (tempfile.mkdtemp(), tempfile.mkdtemp())
+
+        def write_template(template_dir, content):
+            with open(path.join(template_dir, 'page.html'), 'w') as template_file:
+                template_file.write(content)
+        try:
+            write_template(template_dirs[1], 'two')
+            with override_settings(TEMPLATE_DIRS=template_dirs):
+                indexed_loader = Loader()
+                self.assertEqual(indexed_loader.load_template_source('page.html'),
+                                 ('two', path.join(template_dirs[1], 'page.html')))
+                self.assertEqual(indexed_loader.get_template_names(), ['page.html'])
+                self.assertRaises(TemplateDoesNotExist, indexed_loader.load_template_source, '../page.html')
+                write_template(template_dirs[0], 'one')
+                self.assertEqual(indexed_loader.load_template_source('page.html')[0], 'two')
+                indexed_loader.refresh()
+                self.assertEqual(indexed_loader.load_template_source('page.html')[0], 'one')
+                os.remove(path.join(template_dirs[0], 'page.html'))
+                self.assertRaises(TemplateDoesNotExist, indexed_loader.load_template_source, 'page.html',
+                                  template_dirs[:1])
+                self.assertEqual(indexed_loader.load_template_source('page.html')[0], 'two')
+                if hasattr(os, 'symlink'):
+                    # The linked directories are indexed, but not the cycles
+                    os.mkdir(path.join(template_dirs[0], 'linked'))
+                    write_template(path.join(template_dirs[0], 'linked'), 'linked')
+                    os.symlink(path.join(template_dirs[0], 'linked'), path.join(template_dirs[1], 'link'))
+                    os.symlink(template_dirs[1], path.join(template_dirs[1], 'link', 'cycle'))
+                    indexed_loader.refresh()
+                    self.assertEqual(indexed_loader.load_template_source('link/page.html')[0], 'linked')
+                    self.assertEqual(indexed_loader.get_template_names(),
+                                     ['link/page.html', 'linked/cycle/page.html', 'linked/page.html',
+                                      'page.html'])
+        finally:
+            for template_dir in template_dirs:
+                shutil.rmtree(template_dir)
+        client = self.__client_login()
+        user_pk = client.session.get('_auth_user_id')
+        template_loaders = settings.TEMPLATE_LOADERS
+        settings.TEMPLATE_LOADERS = tuple(
+            [template_loader.replace('django.template.loaders', 'smartextends.loaders')
+             for template_loader in template_loaders])
+        loader.template_source_loaders = None
+        try:
+            self.check_url(client, reverse('admin:auth_user_change', args=(user_pk,)))
+        finally:
+            settings.TEMPLATE_LOADERS = template_loaders
+            loader.template_source_loaders = None
+
+    def test_smart_extends_prefetch_parents(self):
+        from django.template import Context
+        from example.app.test_helpers import LEVEL_LOADERS
+        for i in range(3):
+            block = '{%% block content %%}{{ block.super }} level %d{%% endblock %%}' % i
+            write_level_template(i, 'chain/page.html', '{% smart_extends "chain/page.html" %}' + block)
+        write_level_template(2, 'chain/page.html', '<html>{% block content %}root 2{% endblock %}</html>')
+        with override_settings(SMART_EXTENDS_PREFETCH_THREADS=3):
+            cached_loader = self.set_level_loaders(3)
+        template = cached_loader('chain/page.html')[0]
+        self.assertEqual(lookups['count'], 3)
+        keys = list(cached_loader.template_cache)
+        self.assertEqual([skip_key for name, dirs_key, skip_key in keys],
+                         [None] + LEVEL_LOADERS[:2])
+        self.assertEqual(template.render(Context()), '<html>root 2 level 1 level 0</html>')
+        self.assertEqual(lookups['count'], 3)
+
+    @skipIf(not hasattr(os, 'fork'), 'os.fork is not available')
+    def test_smart_extends_prefetch_fork(self):
+        # A forked process (e.g. after warming the cache) has its own pool
+        write_level_template(0, 'chain/page.html', '{% smart_extends "chain/page.html" %}')
+        write_level_template(1, 'chain/page.html', '<html></html>')
+        with override_settings(SMART_EXTENDS_PREFETCH_THREADS=2):
+            cached_loader = self.set_level_loaders(2)
+        cached_loader('chain/page.html')
+        pool = cached_loader.get_prefetch_pool()
+        write_level_template(0, 'chain/other.html', '{% extends "chain/page.html" %}')
+        pid = os.fork()
+        if pid == 0:
+            import signal
+            signal.alarm(10)
+            try:
+                cached_loader('chain/other.html')
+                os._exit(cached_loader.get_prefetch_pool() is pool and 2 or 0)
+            except BaseException:
+                os._exit(1)
+        self.assertEqual(os.waitpid(pid, 0)[1], 0)
+        self.assertTrue(cached_loader.get_prefetch_pool() is pool)
+
+    def test_smart_extends_batch_loader(self):
+        import sqlite3
+        from django.template import Context
+        from smartextends.loader import load_sources_from_loader
+        from smartextends.loaders.cached import Loader
+        database = path.join(self.template_root, 'templates.db')
+        connection = sqlite3.connect(database)
+        connection.execute('CREATE TABLE template (name TEXT PRIMARY KEY, content TEXT)')
+        for name in ('batch/a.html', 'batch/b.html'):
+            connection.execute('INSERT INTO template VALUES (?, ?)',
+                               (name, '{%% smart_extends "%s" %%}{%% block content %%}db '
+                                      '{{ block.super }}{%% endblock %%}' % name))
+            write_level_template(0, name, '{% extends "batch/base.html" %}'
+                                          '{% block content %}file {{ block.super }}{% endblock %}')
+        connection.execute('INSERT INTO template VALUES (?, ?)',
+                           ('batch/base.html', '{% block content %}base{% endblock %}'))
+        connection.commit()
+        connection.close()
+        with override_settings(SQLITE_TEMPLATES=database):
+            cached_loader = Loader(['example.app.sqlite_loader.Loader'] + get_level_loader_names(1))
+            sqlite_loader = cached_loader.loaders[0]
+            sources = load_sources_from_loader(sqlite_loader, ['batch/a.html', 'batch/c.html'])
+            self.assertEqual(list(sources.keys()), ['batch/a.html'])
+            self.assertEqual(sqlite_loader.queries, 1)
+            self.assertEqual(cached_loader.load_templates(['batch/a.html', 'batch/b.html']), 5)
+            self.assertEqual(sqlite_loader.queries, 3)
+            self.assertEqual(cached_loader.load_templates(['batch/a.html', 'batch/b.html']), 0)
+            from django.template import loader
+            loader.template_source_loaders = (cached_loader,)
+            self.assertEqual(cached_loader('batch/a.html')[0].render(Context()), 'db file base')
+            self.assertEqual(sqlite_loader.queries, 3)
+
+    def test_smart_extends_compile(self):
+        from django.template import Context, loader
+        client = self.__client_login()
+        user_pk = client.session.get('_auth_user_id')
+        urls = (reverse('admin:auth_user_change', args=(user_pk,)), reverse('admin:auth_group_add'))
+        contents = {}
+        for compile_python in (False, True):
+            with override_settings(SMART_EXTENDS_COMPILE=compile_python):
+                self.add_cache_template()
+                try:
+                    contents[compile_python] = [client.get(url).content for url in urls for i in range(2)]
+                    cached_loader = loader.template_source_loaders[0]
+                    node = cached_loader.template_cache.peek(('admin/change_form.html', None, None)).nodelist[0]
+                    self.assertEqual(node.compiled is not None, compile_python)
+                finally:
+                    self.remove_cache_template()
+        self.assertEqual(contents[False], contents[True])
+
+        levels = (
+            '{% smart_extends "diff/page.html" %}'
+            '{% block body %}L0 {{ block.super }}{% endblock %}'
+            '{% block item %}<{{ item }}|{{ block.super }}>{% endblock %}'
+            '{% block footer %}{% if show %}{{ block.super }}{% endif %} {{ html }}{% endblock %}',
+            '{% smart_extends "diff/page.html" %}'
+            '{% block title %}{{ block.super }} &amp; L1{% endblock %}'
+            '{% block inner %}L1 {{ block.super }}{% endblock %}',
+            '<h1>{% block title %}Root {{ title }}{% endblock %}</h1>\n'
+            '{% if show %}{% block body %}body {% block inner %}inner {{ value }}{% endblock %}'
+            '{% endblock %}{% endif %}\n'
+            '{% for item in items %}{% block item %}[{{ item }}]{% endblock %}{% endfor %}\n'
+            '{% block footer %}{% with x=title %}{{ x|upper }}{% endwith %}{% endblock %}\n')
+        for i, content in enumerate(levels):
+            write_level_template(i, 'diff/page.html', content)
+        write_level_template(0, 'diff/child.html',
+                             '{% extends "diff/page.html" %}{% block title %}child {{ block.super }}{% endblock %}')
+        contexts = [{'title': 'T<', 'show': True, 'items': [1, 2], 'value': 'v', 'html': '<b>'},
+                    {'title': 'T', 'show': False, 'items': [], 'value': 'v', 'html': ''}]
+        outputs = {}
+        for compile_python in (False, True):
+            with override_settings(SMART_EXTENDS_COMPILE=compile_python):
+                self.set_level_loaders(3)
+                outputs[compile_python] = [loader.get_template(name).render(Context(context))
+                                           for name in ('diff/page.html', 'diff/child.html')
+                                           for context in contexts for i in range(2)]
+        self.assertEqual(outputs[False], outputs[True])
+        self.assertTrue('Root T&lt; &amp; L1' in outputs[True][0])
+        self.assertTrue('L0 body L1 inner v' in outputs[True][0])
+        self.assertTrue('<1|[1]>' in outputs[True][0])
+
+    def test_smart_extends_cached_block(self):
+        from django.template import Context, Template, loader
+        from smartextends.block_cache import get_block_cache, reset_block_cache
+        from smartextends.loader import invalidate_template
+        self.assertRaises(TemplateSyntaxError, Template,
+                          '{% block side %}{% endblock %}{% cached_block side %}{% endcached_block %}')
+        calls = []
+
+        def counter():
+            calls.append(1)
+            return len(calls)
+        write_level_template(0, 'cached_block/page.html',
+                             '{% smart_extends "cached_block/page.html" %}'
+                             '{% cached_block side user %}[{{ block.super }}]{% endcached_block side %}')
+        write_level_template(1, 'cached_block/page.html',
+                             '<p>{% block side %}side {{ counter }}{% endblock %}</p>{{ counter }}')
+        for compile_python in (False, True):
+            reset_block_cache()
+            del calls[:]
+            with override_settings(SMART_EXTENDS_COMPILE=compile_python):
+                self.set_level_loaders(2)
+                template = loader.get_template('cached_block/page.html')
+                self.assertEqual(template.render(Context({'user': 'a', 'counter': counter})),
+                                 '<p>[side 1]</p>2')
+                self.assertEqual(template.render(Context({'user': 'a', 'counter': counter})),
+                                 '<p>[side 1]</p>3')
+                self.assertEqual(template.render(Context({'user': 'b', 'counter': counter})),
+                                 '<p>[side 4]</p>5')
+                self.assertEqual(len(get_block_cache()), 2)
+
+        # The same block in templates with other parents
+        block = '{% cached_block side %}{{ block.super }}{% endcached_block %}'
+        for name in ('a', 'b'):
+            write_level_template(0, 'cached_block/%s.html' % name,
+                                 '{%% extends "cached_block/parent_%s.html" %%}%s' % (name, block))
+            write_level_template(0, 'cached_block/parent_%s.html' % name,
+                                 '{%% block side %%}PARENT %s{%% endblock %%}' % name.upper())
+        reset_block_cache()
+        self.set_level_loaders(1)
+        self.assertEqual(loader.get_template('cached_block/a.html').render(Context()), 'PARENT A')
+        self.assertEqual(loader.get_template('cached_block/b.html').render(Context()), 'PARENT B')
+        self.assertEqual(Template('{% cached_block side %}x{% endcached_block %}').render(Context()), 'x')
+        self.assertEqual(len(get_block_cache()), 3)
+        # A parent that changes is rendered again after it is invalidated
+        write_level_template(0, 'cached_block/parent_a.html', '{% block side %}NEW A{% endblock %}')
+        self.assertEqual(loader.get_template('cached_block/a.html').render(Context()), 'PARENT A')
+        invalidate_template('cached_block/parent_a.html')
+        self.assertEqual(len(get_block_cache()), 0)
+        self.assertEqual(loader.get_template('cached_block/a.html').render(Context()), 'NEW A')
+
+    def test_smart_extends_without_debug(self):
+        from django.template import Context, loader
+        from example.app.test_helpers import get_admin_context
+        client = self.__client_login()
+        user_pk = client.session.get('_auth_user_id')
+        url = reverse('admin:auth_user_change', args=(user_pk,))
+        template_loaders = settings.TEMPLATE_LOADERS
+        with override_settings(TEMPLATE_DEBUG=False):
+            self.add_cache_template()
+            try:
+                self.check_url(client, url)
+                cached_loader = loader.template_source_loaders[0]
+                node = cached_loader.template_cache.peek(('admin/change_form.html', None, None)).nodelist[0]
+                self.assertEqual(node.origin.loadname, 'admin/change_form.html')
+                self.assertEqual(node.get_origin().loadname, 'admin/change_form.html')
+            finally:
+                self.remove_cache_template()
+            settings.TEMPLATE_LOADERS = ('smartextends.loaders.filesystem.Loader',
+                                         'smartextends.loaders.app_directories.Loader')
+            loader.template_source_loaders = None
+            try:
+                content = loader.get_template('admin/change_form.html').render(Context(get_admin_context()))
+                self.assertTrue('Overwriting the change_form template in our project' in content)
+            finally:
+                settings.TEMPLATE_LOADERS = template_loaders
+                loader.template_source_loaders = None
+
+        # The templates included by a template that smartextends compiles do
+        # not get its origin, they are loaded by other loaders
+        from django.template import Template
+        from django.template.loader import find_template_loader
+        from smartextends.loader import compiling
+        write_level_template(0, 'include/page.html', '{% smart_extends "include/page.html" %}')
+        loader.template_source_loaders = tuple([find_template_loader(name) for name in get_level_loader_names(1)])
+        with compiling(loader.template_source_loaders[0], 'include/outer.html'):
+            template = Template('{% smart_extends "include/outer.html" %}{% block a %}'
+                                '{% include "include/page.html" %}'
+                                '{% cached_block b %}{% endcached_block %}{% endblock %}')
+        node = template.nodelist[0]
+        self.assertEqual(node.origin.loadname, 'include/outer.html')
+        include = node.blocks['a'].nodelist[0]
+        self.assertEqual(include.template.nodelist[0].origin, None)
+        self.assertTrue(node.blocks['b'].nodelist.origin_key.endswith(':include/outer.html'))
+
+    def test_smart_extends_streaming(self):
+        from django.template import Context, loader
+        from example.app.test_helpers import get_admin_context
+        from smartextends.streaming import render_to_stream
+        levels = (
+            '{% smart_extends "stream/page.html" %}'
+            '{% block body %}L0 {{ block.super }}{% endblock %}'
+            '{% block item %}<{{ item }}|{{ block.super }}>{% endblock %}',
+            '{% smart_extends "stream/page.html" %}'
+            '{% block title %}{{ block.super }} &amp; L1{% endblock %}'
+            '{% cached_block inner %}L1 {{ block.super }}{% endcached_block %}',
+            '<h1>{% block title %}Root {{ title }}{% endblock %}</h1>\n'
+            '{% block body %}body {% block inner %}inner {{ value }}{% endblock %}{% endblock %}\n'
+            '{% for item in items %}{% block item %}[{{ item }}]{% endblock %}{% endfor %}\n')
+        for i, content in enumerate(levels):
+            write_level_template(i, 'stream/page.html', content)
+        write_level_template(0, 'stream/child.html',
+                             '{% extends "stream/page.html" %}{% block title %}child {{ block.super }}{% endblock %}')
+        context = {'title': 'T<', 'items': [1, 2], 'value': 'v'}
+        for flatten in (False, True):
+            with override_settings(SMART_EXTENDS_FLATTEN=flatten):
+                self.set_level_loaders(3)
+                for name in ('stream/page.html', 'stream/child.html'):
+                    content = loader.get_template(name).render(Context(context))
+                    chunks = list(render_to_stream(name, context, chunk_size=1))
+                    self.assertTrue(len(chunks) > 1)
+                    self.assertEqual(''.join(chunks), content)
+                self.assertTrue('<h1>child Root T&lt; &amp; L1</h1>' in content)
+                self.assertTrue('L0 body L1 inner v' in content)
+        # The dictionary is popped from the context when the stream ends
+        context_instance = Context({'title': 'T<'})
+        chunks = render_to_stream('stream/page.html', {'items': [1]}, context_instance)
+        self.assertEqual(context_instance['items'], [1])
+        self.assertTrue('[1]' in ''.join(chunks))
+        self.assertRaises(KeyError, context_instance.__getitem__, 'items')
+        # The template is loaded before the response starts
+        self.assertRaises(TemplateDoesNotExist, render_to_stream, 'stream/missing.html')
+
+        self.add_cache_template()
+        try:
+            content = loader.get_template('admin/change_form.html').render(Context(get_admin_context()))
+            chunks = list(render_to_stream('admin/change_form.html', context_instance=Context(get_admin_context())))
+            self.assertEqual(''.join(chunks), content)
+            self.assertTrue('Overwriting the change_form template in our project' in chunks[0])
+        finally:
+            self.remove_cache_template()
+
+    def test_smart_extends_lazy_blocks(self):
+        from django.template import Context, loader
+        from django.template.loader_tags import BlockNode
+        from smartextends.templatetags.smart_extends_tags import LazyBlockNode
+        write_level_template(0, 'lazy/page.html',
+                             '{% smart_extends "lazy/page.html" %}{% load i18n %}'
+                             '{% block title %}{% trans "Title" %} {{ block.super|upper }}{% endblock %}'
+                             '{% block body %}[{% block inner %}{{ value }}{% endblock %}]{% endblock %}'
+                             '{% block unused %}{% if %}{% endblock %}'
+                             '{% block comment %}{% comment %}{% endblock %}{% endcomment %}'
+                             '{% verbatim %}{% endblock %}{% endverbatim %}{% endblock %}')
+        write_level_template(1, 'lazy/page.html',
+                             '<h1>{% block title %}root{% endblock %}</h1>{% block body %}body{% endblock %}')
+        with override_settings(SMART_EXTENDS_LAZY_BLOCKS=True):
+            self.set_level_loaders(2)
+            template = loader.get_template('lazy/page.html')
+            blocks = template.nodelist[0].blocks
+            self.assertEqual(type(blocks['body']), BlockNode)
+            self.assertTrue(isinstance(blocks['inner'], LazyBlockNode))
+            self.assertNotEqual(blocks['title'].lazy, None)
+            self.assertEqual(template.render(Context({'value': 'v'})), '<h1>Title ROOT</h1>[v]')
+            self.assertTrue(isinstance(blocks['comment'], LazyBlockNode))
+            self.assertEqual(blocks['comment'].nodelist.render(Context()), '{% endblock %}')
+            self.assertEqual(blocks['title'].lazy, None)
+            self.assertEqual(blocks['inner'].lazy, None)
+            # The errors of the blocks are raised when they are used
+            self.assertRaises(TemplateSyntaxError, lambda: blocks['unused'].nodelist)
+            # The libraries of a load tag are used by the next blocks
+            write_level_template(0, 'lazy/load.html',
+                                 '{% smart_extends "lazy/page.html" %}'
+                                 '{% block title %}{% load l10n %}{{ 1000|unlocalize }}{% endblock %}'
+                                 '{% block body %}{% localize off %}{{ value }}{% endlocalize %}{% endblock %}')
+            template = loader.get_template('lazy/load.html')
+            blocks = template.nodelist[0].blocks
+            self.assertEqual(type(blocks['title']), BlockNode)
+            self.assertTrue(isinstance(blocks['body'], LazyBlockNode))
+            self.assertEqual(template.render(Context({'value': 'v'})), '<h1>1000</h1>v')
+        loader.template_source_loaders = None
+
+        client = self.__client_login()
+        user_pk = client.session.get('_auth_user_id')
+        url = reverse('admin:auth_user_change', args=(user_pk,))
+        contents = []
+        for lazy in (False, True):
+            with override_settings(SMART_EXTENDS_LAZY_BLOCKS=lazy):
+                self.add_cache_template()
+                try:
+                    contents.append(client.get(url).content)
+                    template = loader.get_template('admin/change_form.html')
+                    self.assertEqual(isinstance(template.nodelist[0].blocks['content_title'], LazyBlockNode), lazy)
+                finally:
+                    self.remove_cache_template()
+        self.assertEqual(contents[0], contents[1])
+
+    def test_smart_extends_shared_templates(self):
+        from smartextends.loaders.cached import Loader
+        write_level_template(0, 'shared/page.html', 'shared {{ value }}')
+        cached_loader = Loader(get_level_loader_names(1))
+        # The directories do not change the template that this loader finds
+        templates = [cached_loader.load_template('shared/page.html', dirs)[0]
+                     for dirs in (None, ['a'], ['b'])]
+        self.assertTrue(templates[0] is templates[1] is templates[2])
+        self.assertEqual(cached_loader.shared_stats(),
+                         {'keys': 3, 'templates': 1, 'shared': 2, 'saved': 2 * len('shared {{ value }}')})
+        cached_loader.invalidate('shared/page.html')
+        template = cached_loader.load_template('shared/page.html')[0]
+        self.assertFalse(template is templates[0])
+        with override_settings(SMART_EXTENDS_SHARE_TEMPLATES=False):
+            cached_loader = Loader(get_level_loader_names(1))
+            templates = [cached_loader.load_template('shared/page.html', dirs)[0] for dirs in (None, ['a'])]
+            self.assertFalse(templates[0] is templates[1])
+            self.assertEqual(cached_loader.shared_stats()['shared'], 0)
+
+    def test_smart_extends_inspect_template_cache(self):
+        from django.core.management import call_command
+        from django.utils.six import StringIO
+        from smartextends.memory import (get_cached_loaders, get_template_size, inspect_template_cache,
+                                         total_template_cache_size)
+        from smartextends.warmup import warm_template_cache
+        self.assertEqual(get_cached_loaders(), [])
+        self.add_cache_template()
+        try:
+            # The parents are loaded by the warm up (or by the render)
+            warm_template_cache(['admin/change_form.html'])
+            cached_loader = get_cached_loaders()[0]
+            entries = inspect_template_cache(cached_loader)
+            self.assertEqual(len(entries), len(cached_loader.template_cache))
+            self.assertEqual([entry['size'] for entry in entries],
+                             sorted([entry['size'] for entry in entries], reverse=True))
+            entry = [entry for entry in entries if entry['key'] == ('admin/change_form.html', None, None)][0]
+            # With dbtemplates there is other level
+            self.assertEqual(entry['depth'], len(entry['levels']))
+            self.assertEqual([display_name.split(os.sep)[-1] for loader_name, display_name in entry['levels'][-4:]],
+                             ['change_form.html', 'change_form.html', 'base_site.html', 'base.html'])
+            self.assertTrue(entry['levels'][-4][0].endswith('filesystem.Loader'))
+            self.assertTrue(entry['levels'][-3][0].endswith('app_directories.Loader'))
+            self.assertTrue(entry['nodes'] > 0)
+            self.assertTrue(0 < entry['size'] < total_template_cache_size(entries))
+            stdout = StringIO()
+            call_command('inspect_smart_extends_cache', 'admin/change_form.html', stdout=stdout, verbosity=2)
+            self.assertTrue('levels admin/change_form.html' in stdout.getvalue())
+            self.assertTrue('app_directories.Loader' in stdout.getvalue())
+        finally:
+            self.remove_cache_template()
+
+        # The nodes of the parents kept by the flattened chain are not counted in the child
+        from django.template import Context, loader
+        write_level_template(0, 'memory/page.html',
+                             '{% smart_extends "memory/page.html" %}{% block body %}{{ block.super }}{% endblock %}')
+        write_level_template(1, 'memory/page.html', '<p>{% block body %}{% if x %}{{ x }}{% endif %}{% endblock %}</p>')
+        for compile_python in (False, True):
+            with override_settings(SMART_EXTENDS_COMPILE=compile_python):
+                cached_loader = self.set_level_loaders(2)
+                template = loader.get_template('memory/page.html')
+                size = get_template_size(template)
+                template.render(Context())
+                self.assertEqual(get_template_size(template), size)
+                entries = dict((entry['key'], entry) for entry in inspect_template_cache(cached_loader))
+                self.assertEqual(entries[('memory/page.html', None, None)]['depth'], 2)
+
+        # The chains that loop are inspected too
+        write_level_template(0, 'memory/a.html', '{% extends "memory/b.html" %}')
+        write_level_template(0, 'memory/b.html', '{% extends "memory/a.html" %}')
+        cached_loader = self.set_level_loaders(1)
+        warm_template_cache(['memory/a.html', 'memory/b.html'])
+        entries = dict((entry['key'], entry) for entry in inspect_template_cache(cached_loader))
+        self.assertEqual(entries[('memory/a.html', None, None)]['depth'], 2)
@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2010-2013 by Pablo Martín <goinnn@gmail.com>
+#
+# This software is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This software is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this software.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+try:
+    import tracemalloc
+except ImportError:  # Python < 3.4
+    tracemalloc = None
+
+try:
+    import resource
+except ImportError:  # Not a Unix
+    resource = None
+
+import django
+
+from django.conf import settings
+from django.template import Context, loader
+from django.template.loader import find_template_loader
+from django.test.utils import override_settings
+
+from smartextends.loader import lexer_sets_source
+
+from example.app.test_helpers import (LEVELS, get_admin_context, get_level_loader_names, lookups,
+                                      write_level_template)
+
+MAX_LOADERS = LEVELS
+CHAIN_TEMPLATE = 'bench/page.html'
+EXTENDS_TEMPLATE = 'bench/extends_%d.html'
+
+
+def create_chains(levels):
+    """
+    Creates a directory for each level: a chain of templates that
+    smart_extends themselves and an equivalent chain with extends.
+    """
+    for i in range(levels):
+        block = '{%% block content %%}{{ block.super }} level %d{%% endblock %%}' % i
+        if i < levels - 1:
+            write_level_template(i, CHAIN_TEMPLATE, '{%% smart_extends "%s" %%}%s' % (CHAIN_TEMPLATE, block))
+            write_level_template(i, EXTENDS_TEMPLATE % i,
+                                 '{%% extends "%s" %%}%s' % (EXTENDS_TEMPLATE % (i + 1), block))
+        else:
+            root = '<html>{%% block content %%}root %d{%% endblock %%}</html>' % i
+            write_level_template(i, CHAIN_TEMPLATE, root)
+            write_level_template(i, EXTENDS_TEMPLATE % i, root)
+
+
+def set_loaders(loaders, cached):
+    if cached:
+        loaders = [('smartextends.loaders.cached.Loader', tuple(loaders))]
+    loader.template_source_loaders = tuple([find_template_loader(template_loader)
+                                            for template_loader in loaders])
+
+
+def get_max_rss():
+    "Returns the maximum resident set size of this process in KiB"
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':  # In bytes
+        max_rss /= 1024.0
+    return max_rss
+
+
+def measure(name, context, iterations):
+    """
+    Returns the milliseconds and the lookups per render (loading the template
+    as a view does) and the peak of memory of a render in KiB. Without
+    tracemalloc (Python < 3.4) the peak is the growth of the maximum resident
+    set size of the process while the template is loaded and rendered, an
+    upper bound that is 0 if the process used that memory before. It is None
+    if neither tracemalloc nor resource are available.
+    """
+    max_rss = get_max_rss() if resource is not None else None
+    loader.get_template(name).render(Context(context))  # compile it if it is cached
+    lookups['count'] = 0
+    start = time.time()
+    for i in range(iterations):
+        loader.get_template(name).render(Context(context))
+    elapsed = (time.time() - start) * 1000.0 / iterations
+    lookups_per_render = float(lookups['count']) / iterations
+    peak = None
+    if tracemalloc is not None:
+        tracemalloc.start()
+        loader.get_template(name).render(Context(context))
+        peak = tracemalloc.get_traced_memory()[1] / 1024.0
+        tracemalloc.stop()
+    elif resource is not None:
+        peak = get_max_rss() - max_rss
+    return elapsed, lookups_per_render, peak
+
+
+def run_benchmarks(iterations=100, max_loaders=MAX_LOADERS):
+    """
+    Renders the chains of templates with 1 to max_loaders loaders and the
+    change_form template of the example project, with and without the
+    cached loader. Returns a list of rows (scenario, loaders, cached,
+    milliseconds per render, lookups per render, peak KiB).
+    """
+    rows = []
+    old_loaders = loader.template_source_loaders
+    root_dir = tempfile.mkdtemp()
+    try:
+        for levels in range(1, max_loaders + 1):
+            level_dirs = [os.path.join(root_dir, str(levels), 'level%d' % i) for i in range(levels)]
+            with override_settings(LEVEL_TEMPLATE_DIRS=level_dirs):
+                create_chains(levels)
+                for cached in (False, True):
+                    for scenario, name in (('smart_extends', CHAIN_TEMPLATE),
+                                           ('extends', EXTENDS_TEMPLATE % 0)):
+                        set_loaders(get_level_loader_names(levels), cached)
+                        try:
+                            result = measure(name, {}, iterations)
+                        except Exception as e:
+                            result = (e, None, None)
+                        rows.append((scenario, levels, cached) + result)
+        admin_loaders = ['django.template.loaders.filesystem.Loader',
+                         'django.template.loaders.app_directories.Loader']
+        for cached in (False, True):
+            set_loaders(admin_loaders, cached)
+            try:
+                # Only the benchmark loaders count their lookups
+                result = measure('admin/change_form.html', get_admin_context(), iterations)
+                result = (result[0], None, result[2])
+            except Exception as e:
+                result = (e, None, None)
+            rows.append(('admin/change_form.html', len(admin_loaders), cached) + result)
+    finally:
+        loader.template_source_loaders = old_loaders
+        shutil.rmtree(root_dir)
+    return rows
+
+
+def format_rows(rows):
+    lines = ['Django %s, TEMPLATE_DEBUG = %s, patched = %s' % (django.get_version(),
+                                                               settings.TEMPLATE_DEBUG,
+                                                               lexer_sets_source()),
+             '%-24s %7s %6s %12s %15s %10s' % ('scenario', 'loaders', 'cached',
+                                               'ms/render', 'lookups/render', 'peak KiB')]
+    for scenario, levels, cached, elapsed, lookups_per_render, peak in rows:
+        if isinstance(elapsed, Exception):
+            lines.append('%-24s %7d %6s error: %r' % (scenario, levels, cached, elapsed))
+            continue
+        lines.append('%-24s %7d %6s %12.3f %15s %10s' % (
+            scenario, levels, cached, elapsed,
+            lookups_per_render is None and '-' or '%.1f' % lookups_per_render,
+            peak is None and '-' or '%.1f' % peak))
+    return '\n'.join(lines)
@@ -0,0 +1,38 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2010-2013 by Pablo Martín <goinnn@gmail.com>
+#
+# This software is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This software is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this software.  If not, see <http://www.gnu.org/licenses/>.
+
+# Usage: run_benchmarks.py [settings module] [iterations]
+
+import os
+import sys
+
+from django.conf import ENVIRONMENT_VARIABLE
+
+
+if len(sys.argv) == 1:
+    os.environ[ENVIRONMENT_VARIABLE] = 'example.settings'
+else:
+    os.environ[ENVIRONMENT_VARIABLE] = sys.argv[1]
+
+iterations = 100
+if len(sys.argv) > 2:
+    iterations = int(sys.argv[2])
+
+from example.benchmarks import format_rows, run_benchmarks
+
+print(format_rows(run_benchmarks(iterations)))
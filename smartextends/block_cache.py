@@ -0,0 +1,124 @@
+# Copyright (c) 2010-2013 by Pablo Martin <goinnn@gmail.com>
+#
+# This software is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This software is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this software.  If not, see <http://www.gnu.org/licenses/>.
+
+import hashlib
+import uuid
+
+from django.conf import settings
+from django.template.base import NodeList
+from django.utils.encoding import force_bytes, force_text
+from django.utils.safestring import mark_safe
+
+from smartextends.cache import LRUCache
+from smartextends.loader import get_loader_key, get_parent_cache_generation
+
+_block_cache = None
+_block_cache_generation = None
+
+
+def get_block_cache():
+    """
+    Returns the cache of the output of the cached blocks: the Django cache
+    SMART_EXTENDS_BLOCK_CACHE (an alias of CACHES) if it is set, else a
+    LRUCache of SMART_EXTENDS_BLOCK_CACHE_SIZE entries (by default 1000) of
+    this process. The LRUCache is emptied when the templates are
+    invalidated (see smartextends.loader.invalidate_parent_cache).
+    """
+    global _block_cache, _block_cache_generation
+    if _block_cache is None:
+        alias = getattr(settings, 'SMART_EXTENDS_BLOCK_CACHE', None)
+        if alias:
+            from django.core.cache import get_cache
+            _block_cache = get_cache(alias)
+        else:
+            _block_cache = LRUCache(getattr(settings, 'SMART_EXTENDS_BLOCK_CACHE_SIZE', 1000))
+        _block_cache_generation = get_parent_cache_generation()
+    elif _block_cache_generation != get_parent_cache_generation():
+        if isinstance(_block_cache, LRUCache):
+            _block_cache.clear()
+        _block_cache_generation = get_parent_cache_generation()
+    return _block_cache
+
+
+def reset_block_cache():
+    """
+    Empties the cache of blocks of this process, the next call reads again
+    its settings.
+    """
+    global _block_cache
+    if isinstance(_block_cache, LRUCache):
+        _block_cache.clear()
+    _block_cache = None
+
+
+def get_tokens_key(tokens):
+    "Returns a hash of the contents of a list of tokens."
+    contents = '\n'.join(['%d:%s' % (token.token_type, token.contents) for token in tokens])
+    return hashlib.sha1(force_bytes(contents)).hexdigest()
+
+
+def get_origin_key(origin):
+    """
+    Returns the identity of the template of a cached block: the loader and
+    the name of its origin. If they are unknown (e.g. a template compiled
+    from a string) the key is unique, so the block is only shared by the
+    renders of this compiled template.
+    """
+    loader = getattr(origin, 'loader', None)
+    loadname = getattr(origin, 'loadname', None)
+    if loader is None or loadname is None:
+        return uuid.uuid4().hex
+    loader_key = get_loader_key(loader)
+    return '%s.%s:%s' % (getattr(loader_key, '__module__', ''),
+                         getattr(loader_key, '__name__', repr(loader_key)), loadname)
+
+
+class CachedNodeList(NodeList):
+    """
+    The node list of a cached block. Its output is kept in the cache of
+    blocks, by the template of the block (its loader and name), the hash of
+    the tokens of the block (so it changes when the block changes), the
+    values of the variables of the block tag and the generation of the
+    cache of parents (so it changes when the templates are invalidated).
+    """
+
+    def __init__(self, nodelist, tokens_key, vary_on=(), origin_key=''):
+        super(CachedNodeList, self).__init__(nodelist)
+        self.contains_nontext = nodelist.contains_nontext
+        self.nodelist = nodelist
+        self.tokens_key = tokens_key
+        self.vary_on = vary_on
+        self.origin_key = origin_key
+
+    def render_node(self, node, context):
+        return self.nodelist.render_node(node, context)
+
+    def get_cache_key(self, context):
+        values = [force_text(var.resolve(context)) for var in self.vary_on]
+        generation = str(get_parent_cache_generation())
+        key = hashlib.sha1(force_bytes('|'.join([generation, self.origin_key, self.tokens_key] + values))).hexdigest()
+        return 'smartextends.block.%s' % key
+
+    def render(self, context):
+        cache = get_block_cache()
+        key = self.get_cache_key(context)
+        output = cache.get(key)
+        if output is None:
+            output = super(CachedNodeList, self).render(context)
+            if isinstance(cache, LRUCache):
+                cache.set(key, output, len(output))
+            else:
+                cache.set(key, output, getattr(settings, 'SMART_EXTENDS_BLOCK_CACHE_TIMEOUT', None))
+        return mark_safe(output)
@@ -0,0 +1,124 @@
+# Copyright (c) 2010-2013 by Pablo Martin <goinnn@gmail.com>
+#
+# This software is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This software is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this software.  If not, see <http://www.gnu.org/licenses/>.
+
+import threading
+
+try:
+    from collections import OrderedDict
+except ImportError:  # Python 2.6
+    from django.utils.datastructures import SortedDict as OrderedDict
+
+
+class LRUCache(object):
+    """
+    A dictionary with a maximum number of entries (max_entries) and a maximum
+    total size (max_size, the sum of the sizes given when the entries are set).
+    When it is full the least recently used entries are discarded. If these
+    limits are None the cache is unbounded, and if max_entries is 0 nothing
+    is stored. It counts the hits, misses and evictions. on_evict is called
+    with the key and the value of every discarded entry.
+    """
+
+    def __init__(self, max_entries=None, max_size=None, on_evict=None):
+        self.max_entries = max_entries
+        self.max_size = max_size
+        self.on_evict = on_evict
+        self.data = OrderedDict()
+        self.sizes = {}
+        self.size = 0
+        self.hits = self.misses = self.evictions = 0
+        self.lock = threading.RLock()
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def __len__(self):
+        return len(self.data)
+
+    def __iter__(self):
+        return iter(list(self.data.keys()))
+
+    def is_full(self):
+        return ((self.max_entries is not None and len(self.data) > self.max_entries) or
+                (self.max_size is not None and self.size > self.max_size))
+
+    def is_bounded(self):
+        return self.max_entries is not None or self.max_size is not None
+
+    def peek(self, key, default=None):
+        "Returns the value of a key without counting nor updating its use."
+        return self.data.get(key, default)
+
+    def get(self, key, default=None):
+        if not self.is_bounded():
+            # Without limits the order of use does not matter, so the hits
+            # do not need the lock
+            value = self.data.get(key, default)
+            if value is default:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return value
+        with self.lock:
+            try:
+                value = self.data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self.data[key] = value
+            self.hits += 1
+            return value
+
+    def set(self, key, value, size=0):
+        if self.max_entries == 0:
+            return
+        evicted = []
+        with self.lock:
+            self._delete(key)
+            self.data[key] = value
+            if size:
+                self.sizes[key] = size
+                self.size += size
+            # The last entry is kept although it is bigger than max_size
+            while len(self.data) > 1 and self.is_full():
+                evicted_key = next(iter(self.data))
+                evicted.append((evicted_key, self.data[evicted_key]))
+                self._delete(evicted_key)
+                self.evictions += 1
+        if self.on_evict is not None:
+            # Without the lock, the callback can use other locks
+            for evicted_key, evicted_value in evicted:
+                self.on_evict(evicted_key, evicted_value)
+
+    def _delete(self, key):
+        self.data.pop(key, None)
+        self.size -= self.sizes.pop(key, 0)
+
+    def delete(self, key):
+        with self.lock:
+            self._delete(key)
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+            self.sizes.clear()
+            self.size = 0
+
+    def stats(self):
+        return {'entries': len(self.data),
+                'size': self.size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions}
@@ -0,0 +1,111 @@
+# Copyright (c) 2010-2013 by Pablo Martin <goinnn@gmail.com>
+#
+# This software is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This software is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this software.  If not, see <http://www.gnu.org/licenses/>.
+
+from django.template.base import NodeList, TextNode, VariableNode
+from django.template.loader_tags import BlockNode
+from django.utils.encoding import force_text
+from django.utils.safestring import mark_safe
+
+
+class ChainCompiler(object):
+    """
+    Translates the nodes of a flattened chain of templates (see
+    SmartExtendsNode.get_flattened) into the source of a Python function
+    render(context, block_context). The text of the templates is appended
+    as it is, the blocks are replaced by the nodes of the block that the
+    block context gives them (as BlockNode.render does) and the rest of
+    nodes are rendered by their node lists. The block context has to be a
+    new one with the blocks of the chain.
+    """
+
+    def __init__(self, root, blocks):
+        self.root = root
+        self.blocks = blocks
+        self.objects = []
+        self.lines = []
+        self.pushes = 0
+
+    def add_object(self, obj):
+        self.objects.append(obj)
+        return 'objects[%d]' % (len(self.objects) - 1)
+
+    def add_line(self, line, indent):
+        self.lines.append('    ' * indent + line)
+
+    def add_nodelist(self, nodelist, indent):
+        text = []
+        for node in nodelist:
+            if isinstance(node, TextNode):
+                text.append(node.s)
+                continue
+            if text:
+                self.add_line('append(%s)' % self.add_object(force_text(''.join(text))), indent)
+                text = []
+            if isinstance(node, BlockNode):
+                self.add_block(node.name, indent)
+            elif type(node) is VariableNode:
+                self.add_line('append(force_text(%s.render(context)))' % self.add_object(node), indent)
+            else:
+                self.add_line('append(force_text(%s.render_node(%s, context)))' % (
+                    self.add_object(nodelist), self.add_object(node)), indent)
+        if text:
+            self.add_line('append(%s)' % self.add_object(force_text(''.join(text))), indent)
+
+    def add_block(self, name, indent):
+        # The block that the block context pops, the last one of its chain
+        chain = self.blocks.get(name)
+        if not chain:
+            return
+        block = chain[-1]
+        self.pushes += 1
+        push = 'push%d' % self.pushes
+        block_name = self.add_object(name)
+        self.add_line('%s = block_context.pop(%s)' % (push, block_name), indent)
+        self.add_line('block = BlockNode(%s, %s.nodelist)' % (block_name, push), indent)
+        self.add_line('block.context = context', indent)
+        self.add_line('context.push()', indent)
+        self.add_line("context['block'] = block", indent)
+        if type(block.nodelist).render == NodeList.render:
+            self.add_nodelist(block.nodelist, indent)
+        else:
+            # Its node list renders in other way (e.g. the cached blocks)
+            self.add_line('append(force_text(block.nodelist.render(context)))', indent)
+        self.add_line('context.pop()', indent)
+        self.add_line('block_context.push(%s, %s)' % (block_name, push), indent)
+
+    def get_source(self):
+        self.add_line('def render(context, block_context):', 0)
+        self.add_line('bits = []', 1)
+        self.add_line('append = bits.append', 1)
+        self.add_nodelist(self.root.nodelist, 1)
+        self.add_line("return mark_safe(''.join(bits))", 1)
+        return '\n'.join(self.lines) + '\n'
+
+    def compile(self):
+        source = self.get_source()
+        namespace = {'objects': self.objects, 'force_text': force_text,
+                     'mark_safe': mark_safe, 'BlockNode': BlockNode}
+        exec(compile(source, '<smart_extends %s>' % self.root.name, 'exec'), namespace)
+        render = namespace['render']
+        render.source = source
+        return render
+
+
+def compile_chain(root, blocks):
+    """
+    Returns a function render(context, block_context) that renders a
+    flattened chain of templates (see ChainCompiler).
+    """
+    return ChainCompiler(root, blocks).compile()
@@ -13,48 +13,380 @@
 # You should have received a copy of the GNU Lesser General Public License
 # along with this software.  If not, see <http://www.gnu.org/licenses/>.
 
+import threading
+
+from contextlib import contextmanager
+
 from django.conf import settings
 
+from django.template import loader as django_loader
 from django.template import TemplateDoesNotExist
+from django.template.loader import BaseLoader
+from django.template.loader import find_template_loader
 from django.template.loader import get_template_from_string
 from django.template.loader import make_origin
 from django.template.loaders.cached import Loader as CachedLoader
 
+from smartextends import stats
+from smartextends.cache import LRUCache
+
 
 def get_template(template_name, skip_template=None):
     """
     Returns a compiled Template object for the given template name,
     handling template inheritance recursively.
     """
-    template, origin = find_template(template_name, skip_template=skip_template)
+    template, loader, display_name = find_template_source(template_name, skip_template=skip_template)
     if not hasattr(template, 'render'):
         # template needs to be compiled
-        template = get_template_from_string(template, origin, template_name)
+        origin = make_origin(display_name, loader, template_name, None)
+        with compiling(loader, template_name):
+            template = get_template_from_string(template, origin, template_name)
     return template
 
 
+class TemplateOrigin(object):
+    """
+    The loader and the name of a template, what smart_extends needs to skip
+    it. Unlike LoaderOrigin, it does not need TEMPLATE_DEBUG nor the patch.
+    """
+
+    def __init__(self, loader, loadname):
+        self.loader = loader
+        self.loadname = loadname
+
+
+_compiling = threading.local()
+
+
+def lexer_sets_source():
+    """
+    Returns True if the Lexer sets the source of the tokens when
+    TEMPLATE_DEBUG is False, it does it if Django is patched (see patches)
+    """
+    from django.template.base import Lexer
+    return hasattr(Lexer('', None).create_token('', False), 'source')
+
+
+def get_compiling_origin(parser):
+    """
+    Returns the TemplateOrigin of the template that smartextends is loading
+    or compiling in this thread (see compiling), or None. It belongs to the
+    first parser that asks for it (the smart_extends tag is the first tag of
+    its template): the templates compiled meanwhile by other loaders, e.g.
+    the templates of the include tags with a constant name, have other
+    parsers and they get None.
+    """
+    origin = getattr(_compiling, 'origin', None)
+    if origin is None:
+        return None
+    if _compiling.parser is None:
+        # The id is enough, the parser exists until the template is compiled
+        _compiling.parser = id(parser)
+    elif _compiling.parser != id(parser):
+        return None
+    return origin
+
+
+@contextmanager
+def compiling(loader, name):
+    """
+    Sets the origin of the template that is compiled inside this context
+    manager, the smart_extends tags keep it when they are compiled.
+    """
+    previous = (getattr(_compiling, 'origin', None), getattr(_compiling, 'parser', None))
+    _compiling.origin, _compiling.parser = TemplateOrigin(loader, name), None
+    try:
+        yield
+    finally:
+        _compiling.origin, _compiling.parser = previous
+
+
+_parent_cache = None
+_parent_cache_generation = 0
+
+
+def get_parent_cache():
+    """
+    Returns the cache of the parent templates of smart_extends, its keys are
+    tuples (name, key of the loader to skip). Its size is
+    SMART_EXTENDS_PARENT_CACHE_SIZE, by default unbounded.
+    """
+    global _parent_cache
+    if _parent_cache is None:
+        _parent_cache = LRUCache(getattr(settings, 'SMART_EXTENDS_PARENT_CACHE_SIZE', None))
+    return _parent_cache
+
+
+def get_parent_cache_generation():
+    """
+    Returns a number that changes when the cache of parents is invalidated,
+    the nodes that keep a parent template compare it to know if it is valid.
+    """
+    return _parent_cache_generation
+
+
+def invalidate_parent_cache(name=None):
+    """
+    Removes from the cache of parents the templates with this name, or every
+    template if the name is None. The parents kept by the nodes are
+    discarded too.
+    """
+    global _parent_cache_generation
+    parent_cache = get_parent_cache()
+    if name is None:
+        parent_cache.clear()
+    else:
+        for key in parent_cache:
+            if key[0] == name:
+                parent_cache.delete(key)
+    _parent_cache_generation += 1
+
+
+def get_cached_template(template_name, skip_template=None):
+    """
+    Like get_template but the templates are kept in the cache of parents
+    until it is invalidated (see invalidate_parent_cache).
+    """
+    skip_key = None
+    if skip_template is not None and getattr(skip_template, 'loadname', None) == template_name:
+        skip_key = get_loader_key(skip_template.loader)
+    key = (template_name, skip_key)
+    parent_cache = get_parent_cache()
+    template = parent_cache.get(key)
+    if template is None:
+        template = get_template(template_name, skip_template=skip_template)
+        parent_cache.set(key, template)
+    return template
+
+
+def invalidate_template(name):
+    """
+    Invalidates a template name in the loaders with an invalidate method
+    (e.g. smartextends.loaders.cached.Loader removes the templates that
+    depend on it), in the cache of parents and in the cache of misses.
+    """
+    for loader in django_loader.template_source_loaders or ():
+        if hasattr(loader, 'invalidate'):
+            loader.invalidate(name)
+    invalidate_parent_cache(name)
+    invalidate_miss_cache(name)
+
+
+def get_template_source_loaders():
+    """
+    Returns the template loaders of the TEMPLATE_LOADERS setting, the same
+    tuple that django.template.loader.find_template uses.
+    """
+    if django_loader.template_source_loaders is None:
+        loaders = []
+        for loader_name in settings.TEMPLATE_LOADERS:
+            loader = find_template_loader(loader_name)
+            if loader is not None:
+                loaders.append(loader)
+        django_loader.template_source_loaders = tuple(loaders)
+    return django_loader.template_source_loaders
+
+
+def get_loader_key(loader):
+    """
+    Returns the object that identifies a template loader: the class for the
+    loaders based on classes (or their load_template_source method) and the
+    function for the old way to do template loaders.
+    """
+    if hasattr(loader, '__self__'):
+        return loader.__self__.__class__
+    if hasattr(loader, 'load_template_source'):
+        return loader.__class__
+    return loader
+
+
+class OverrideIndex(object):
+    """
+    For a sequence of template loaders, it stores the stack of loaders that
+    have to be tried after skipping each one of them. It is built lazily and
+    rebuilt when the sequence of loaders changes (e.g. TEMPLATE_LOADERS).
+    """
+
+    def __init__(self):
+        self._index = (None, {})
+
+    def build(self, loaders):
+        stacks = {}
+        cached_loaders = ()
+        for i, loader in enumerate(loaders):
+            if isinstance(loader, CachedLoader):
+                # The cached loaders are never skipped, they know how to skip
+                # the loaders that they wrap
+                cached_loaders += (loader,)
+                continue
+            key = get_loader_key(loader)
+            if key not in stacks:
+                stacks[key] = cached_loaders + tuple(loaders[i + 1:])
+        # If the loader of the template is unknown, only the cached loaders are tried
+        stacks[None] = cached_loaders
+        self._index = (loaders, stacks)
+        return stacks
+
+    def get_loaders(self, loaders, skip_loader):
+        index_loaders, stacks = self._index
+        if index_loaders is not loaders:
+            stacks = self.build(loaders)
+        return stacks.get(get_loader_key(skip_loader), stacks[None])
+
+
+override_index = OverrideIndex()
+
+_miss_cache = None
+
+
+def get_miss_cache():
+    """
+    Returns the cache of the misses of the template loaders, its keys are
+    tuples (loader, name, dirs). Its size is SMART_EXTENDS_MISS_CACHE_SIZE,
+    by default 0 (disabled), because a template created after a miss is not
+    found until the cache is invalidated.
+    """
+    global _miss_cache
+    if _miss_cache is None:
+        _miss_cache = LRUCache(getattr(settings, 'SMART_EXTENDS_MISS_CACHE_SIZE', 0))
+    return _miss_cache
+
+
+def reset_miss_cache():
+    """
+    Empties the cache of misses, the next call reads again its settings.
+    """
+    global _miss_cache
+    _miss_cache = None
+
+
+def invalidate_miss_cache(name):
+    """
+    Removes from the cache of misses the entries of a template name.
+    """
+    miss_cache = get_miss_cache()
+    for key in miss_cache:
+        if key[1] == name:
+            miss_cache.delete(key)
+
+
+_base_load_template = getattr(BaseLoader.load_template, '__func__', BaseLoader.load_template)
+
+
+def get_source_loader(loader):
+    """
+    Returns the load_template_source method of the loaders that compile
+    their templates as django.template.loader.BaseLoader does, so the caller
+    gets the source and can compile it. Else it returns the loader.
+    """
+    load_template = getattr(type(loader), 'load_template', None)
+    if getattr(load_template, '__func__', load_template) is _base_load_template:
+        return loader.load_template_source
+    return loader
+
+
+def load_from_loaders(loaders, name, dirs=None, skip_template=None, sources=False, tried=None):
+    """
+    Returns the tuple (template, loader, display_name) of the first loader
+    that finds the template, remembering the misses in the cache of misses.
+    The cached loaders are not remembered, their result depends on the
+    template to skip, which is passed to the loaders that know how to skip
+    templates (skips_templates). With sources, the template is not compiled
+    if possible (see get_source_loader). The keys of the loaders tried are
+    appended to the tried list, if it is given.
+    """
+    miss_cache = get_miss_cache()
+    use_miss_cache = miss_cache.max_entries != 0
+    dirs_key = dirs and tuple(dirs)
+    for loader in loaders:
+        miss_key = None
+        if use_miss_cache and not isinstance(loader, CachedLoader):
+            miss_key = (loader, name, dirs_key)
+            if miss_key in miss_cache:
+                continue
+        if tried is not None:
+            tried.append(get_loader_key(loader))
+        if sources:
+            loader = get_source_loader(loader)
+        try:
+            with compiling(loader, name):
+                if skip_template is not None and getattr(loader, 'skips_templates', False):
+                    template, display_name = loader.load_template(name, dirs, skip_template=skip_template)
+                else:
+                    template, display_name = loader(name, dirs)
+            return (template, loader, display_name)
+        except TemplateDoesNotExist:
+            if miss_key is not None:
+                miss_cache.set(miss_key, True)
+    raise TemplateDoesNotExist(name)
+
+
+def load_sources_from_loader(loader, names, dirs=None, errors=None):
+    """
+    Returns a dictionary {name: (template, loader, display_name)} with the
+    templates of a list of names that a loader finds. The loaders with a
+    load_template_sources(names, template_dirs=None) method, which returns
+    a dictionary {name: (source, display_name)}, find them in one call, the
+    other loaders are called for each name.
+
+    If errors is a dictionary, the exceptions (but TemplateDoesNotExist) are
+    stored in it by name instead of raising them. If the call with every
+    name fails, the loader is called for each name.
+    """
+    if hasattr(loader, 'load_template_sources'):
+        try:
+            return dict((name, (source, loader, display_name))
+                        for name, (source, display_name) in loader.load_template_sources(names, dirs).items())
+        except Exception:
+            if errors is None:
+                raise
+    found = {}
+    for name in names:
+        try:
+            found[name] = load_from_loaders((loader,), name, dirs, sources=True)
+        except TemplateDoesNotExist:
+            pass
+        except Exception as e:
+            if errors is None:
+                raise
+            errors[name] = e
+    return found
+
+
+def find_template_source(name, dirs=None, skip_template=None):
+    """
+    Returns a tuple with the template (a compiled Template object or its
+    source, it depends on the loader), the loader and the display name.
+    Skipping the current template (skip_template, an origin object with the
+    loader and the name of the template).
+    """
+    start = stats.start()
+    all_loaders = loaders = get_template_source_loaders()
+    if skip_template is not None and getattr(skip_template, 'loadname', None) == name:
+        loaders = override_index.get_loaders(loaders, skip_template.loader)
+    else:
+        skip_template = None
+    if start is None:
+        return load_from_loaders(loaders, name, dirs, skip_template)
+    skipped = [get_loader_key(loader) for loader in all_loaders if loader not in loaders]
+    tried = []
+    found = None
+    try:
+        source, loader, display_name = load_from_loaders(loaders, name, dirs, skip_template,
+                                                         tried=tried)
+        found = get_loader_key(loader)
+    finally:
+        stats.emit(stats.make_event('find_template', name, start, skipped, tried, found,
+                                    smart_extends=skip_template is not None))
+    return (source, loader, display_name)
+
+
 def find_template(name, dirs=None, skip_template=None):
     """
     Returns a tuple with a compiled Template object for the given template name,
     and a origin object. Skipping the current template (skip_template),
     this param contain the absolute path of the template.
     """
-    from django.template.loader import template_source_loaders
-    setattr(name, 'skip_template', skip_template)
-    needs_smart_extends = skip_template.loadname == name
-    found_template_loader = False
-    for loader in template_source_loaders:
-        if needs_smart_extends and not found_template_loader and not isinstance(loader, CachedLoader):
-            if hasattr(loader, 'load_template_source'):
-                if (hasattr(skip_template.loader, '__self__') and
-                   skip_template.loader.__self__.__class__ == loader.__class__):
-                    found_template_loader = True
-            else:  # old way to do template loaders
-                found_template_loader = skip_template.loader == loader
-            continue
-        try:
-            source, display_name = loader(name, dirs)
-            return (source, make_origin(display_name, loader, name, dirs))
-        except TemplateDoesNotExist:
-            pass
-    raise TemplateDoesNotExist(name)
+    source, loader, display_name = find_template_source(name, dirs, skip_template)
+    return (source, make_origin(display_name, loader, name, dirs))
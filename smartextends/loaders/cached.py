@@ -14,56 +14,520 @@
 # along with this software.  If not, see <http://www.gnu.org/licenses/>.
 
 import hashlib
+import os
+import threading
+import time
+import weakref
 
-from django.template.base import TemplateDoesNotExist
+from multiprocessing.pool import ThreadPool
+
+from django.conf import settings
+from django.db import connections
+from django.template.base import TemplateDoesNotExist, TemplateSyntaxError
+from django.template.loader_tags import ExtendsNode
 from django.template.loaders.cached import Loader as CachedLoader
-from django.template.loader import get_template_from_string, make_origin
+from django.template.loader import LoaderOrigin, get_template_from_string, make_origin
 from django.utils.encoding import force_bytes
 
+from smartextends import stats
+from smartextends.cache import LRUCache
+from smartextends.loader import (OverrideIndex, compiling, get_loader_key, invalidate_parent_cache,
+                                 load_from_loaders, load_sources_from_loader, reset_miss_cache)
+from smartextends.templatetags.smart_extends_tags import SmartExtendsNode, get_first_node, is_constant
+
 
 class Loader(CachedLoader):
+    """
+    Cached loader that knows how to skip the loader of a template. The
+    template cache is a LRU cache bounded by SMART_EXTENDS_CACHE_MAX_ENTRIES
+    templates and SMART_EXTENDS_CACHE_MAX_SIZE characters of source (both
+    unbounded by default), its counters are in template_cache.stats().
 
-    def find_template(self, name, dirs=None):
-        skip_template = getattr(name, 'skip_template', None)
-        needs_smart_extends = skip_template and skip_template.loadname == name
-        found_template_loader = False
-        for loader in self.loaders:
-            if needs_smart_extends and not found_template_loader:
-                if hasattr(loader, 'load_template_source'):
-                    if (hasattr(skip_template.loader, '__self__') and
-                       skip_template.loader.__self__.__class__ == loader.__class__):
-                        found_template_loader = True
-                else:  # old way to do template loaders
-                    found_template_loader = skip_template.loader == loader
-                continue
-            try:
-                template, display_name = loader(name, dirs)
-                return (template, make_origin(display_name, loader, name, dirs))
-            except TemplateDoesNotExist:
-                pass
-        raise TemplateDoesNotExist(name)
+    The templates to skip are passed explicitly (skip_template argument of
+    load_template), each combination of template name, template directories
+    and loader to skip has its own key in the cache.
+
+    Only one thread compiles a template that is not in the cache, the other
+    threads that want it wait for its result.
+
+    If SMART_EXTENDS_REVALIDATE_INTERVAL is a number of seconds, the
+    templates read from files are compared with their files (modification
+    time and size) at most once in this interval, and they are compiled again
+    if they changed.
+
+    It knows the templates that depend on each template name (the templates
+    with this name and the templates that extend it with a constant name), so
+    invalidate(name) only removes these templates.
+
+    If SMART_EXTENDS_PREFETCH_THREADS is a number of threads, when a template
+    is compiled its chain of parents with constant names is loaded too,
+    fetching the sources of each parent name from the loaders at the same
+    time in a pool of threads.
+
+    The keys whose templates have the same name, loader, display name and
+    source share one compiled template (unless SMART_EXTENDS_SHARE_TEMPLATES
+    is False), see shared_stats.
+    """
+
+    skips_templates = True
+
+    def __init__(self, loaders):
+        super(Loader, self).__init__(loaders)
+        self.template_cache = LRUCache(getattr(settings, 'SMART_EXTENDS_CACHE_MAX_ENTRIES', None),
+                                       getattr(settings, 'SMART_EXTENDS_CACHE_MAX_SIZE', None),
+                                       on_evict=self.forget)
+        self.override_index = OverrideIndex()
+        self.dirs_keys = {}
+        self.compile_locks = {}
+        self.compile_locks_lock = threading.Lock()
+        self.origins = {}
+        self.dependents = {}
+        self.dependents_lock = threading.Lock()
+        self.revalidate_interval = getattr(settings, 'SMART_EXTENDS_REVALIDATE_INTERVAL', None)
+        self.file_stats = {}
+        self.file_checks = {}
+        self.prefetch_threads = getattr(settings, 'SMART_EXTENDS_PREFETCH_THREADS', 0)
+        self.prefetch_pool = None
+        self.share_templates = getattr(settings, 'SMART_EXTENDS_SHARE_TEMPLATES', True)
+        # The compiled templates are removed when no key has them
+        self.shared_templates = weakref.WeakValueDictionary()
+
+    def find_template(self, name, dirs=None, skip_template=None):
+        return self.find_template_source(name, dirs, skip_template)[:2]
 
-    def load_template(self, template_name, template_dirs=None):
-        key = template_name
+    def find_template_source(self, name, dirs=None, skip_template=None, skipped=None, tried=None):
+        """
+        Returns a tuple with the template (its source or a compiled Template
+        object), the origin object, the loader and the display name. The keys
+        of the loaders skipped and tried are appended to these lists, if they
+        are given.
+        """
+        loaders = self.loaders
+        if skip_template is not None and getattr(skip_template, 'loadname', None) == name:
+            loaders = self.override_index.get_loaders(loaders, skip_template.loader)
+            if skipped is not None:
+                skipped.extend([get_loader_key(loader) for loader in self.loaders
+                                if loader not in loaders])
+        template, loader, display_name = load_from_loaders(loaders, name, dirs, sources=True,
+                                                           tried=tried)
+        return (template, make_origin(display_name, loader, name, dirs), loader, display_name)
+
+    def get_cache_key(self, template_name, template_dirs=None, skip_template=None):
+        dirs_key = skip_key = None
         if template_dirs:
             # If template directories were specified, use a hash to differentiate
-            key = '-'.join([template_name, hashlib.sha1(force_bytes('|'.join(template_dirs))).hexdigest()])
-        if hasattr(template_name, 'skip_template'):
-            skip_loader = template_name.skip_template.loader
-            if hasattr(skip_loader, '__self__'):
-                key = key + '-' + str(template_name.skip_template.loader.__self__.__class__)
+            if not isinstance(template_dirs, tuple):
+                template_dirs = tuple(template_dirs)
+            dirs_key = self.dirs_keys.get(template_dirs)
+            if dirs_key is None:
+                dirs_key = hashlib.sha1(force_bytes('|'.join(template_dirs))).hexdigest()
+                self.dirs_keys[template_dirs] = dirs_key
+        if skip_template is not None:
+            skip_key = get_loader_key(skip_template.loader)
+        return (template_name, dirs_key, skip_key)
+
+    def load_template(self, template_name, template_dirs=None, skip_template=None):
+        start = stats.start()
+        if skip_template is not None and getattr(skip_template, 'loadname', None) != template_name:
+            skip_template = None
+        key = self.get_cache_key(template_name, template_dirs, skip_template)
+        template = self.template_cache.get(key)
+        if template is not None and self.revalidate_interval is not None:
+            changed = self.get_changed_template(key, template)
+            if changed is not None:
+                self.invalidate(changed)
+                invalidate_parent_cache(changed)
+                template = None
+        if template is None:
+            with self.get_compile_lock(key):
+                try:
+                    # Other thread could have compiled it while we were waiting
+                    template = self.template_cache.peek(key)
+                    if template is None:
+                        if start is None:
+                            return self.compile_template(key, template_name, template_dirs,
+                                                         skip_template)
+                        skipped, tried = [], []
+                        try:
+                            return self.compile_template(key, template_name, template_dirs,
+                                                         skip_template, skipped, tried)
+                        finally:
+                            self.emit_event(start, key, 'miss', skipped, tried)
+                finally:
+                    self.release_compile_lock(key)
+        if start is not None:
+            self.emit_event(start, key, 'hit')
+        return template, None
+
+    def emit_event(self, start, key, cache, skipped=(), tried=()):
+        found = None
+        if key in self.origins:
+            found = get_loader_key(self.origins[key][0])
+        stats.emit(stats.make_event('cached_loader', key[0], start, skipped, tried, found, cache,
+                                    smart_extends=key[2] is not None))
+
+    def get_compile_lock(self, key):
+        with self.compile_locks_lock:
+            lock, users = self.compile_locks.get(key, (None, 0))
+            if lock is None:
+                # Reentrant: compiling a template can load other templates
+                lock = threading.RLock()
+            self.compile_locks[key] = (lock, users + 1)
+        return lock
+
+    def release_compile_lock(self, key):
+        with self.compile_locks_lock:
+            lock, users = self.compile_locks[key]
+            if users == 1:
+                del self.compile_locks[key]
+            else:
+                self.compile_locks[key] = (lock, users - 1)
+
+    def compile_template(self, key, template_name, template_dirs=None, skip_template=None,
+                         skipped=None, tried=None):
+        template, origin, loader, display_name = self.find_template_source(template_name, template_dirs,
+                                                                           skip_template, skipped, tried)
+        template, origin = self.store_template(key, template_name, template, origin, loader, display_name)
+        if origin is None and self.prefetch_threads:
+            try:
+                self.prefetch_parents(template_name, template, loader)
+            except (TemplateDoesNotExist, TemplateSyntaxError):
+                # They are raised again when the parents are rendered
+                pass
+        return template, origin
+
+    def store_template(self, key, template_name, template, origin, loader, display_name):
+        """
+        Compiles the source of a template (if it is not compiled) and stores
+        it in the cache. Returns the same as load_template.
+        """
+        size = 0
+        if not hasattr(template, 'render'):
+            size = len(template)
+            shared_key = shared = None
+            if self.share_templates:
+                source_hash = hashlib.sha1(force_bytes(template)).hexdigest()
+                shared_key = (template_name, loader, display_name, source_hash)
+                shared = self.shared_templates.get(shared_key)
+            if shared is not None:
+                template = shared
             else:
-                key = key + '-' + skip_loader.__module__ + '.' + skip_loader.__name__
-        if key not in self.template_cache:
-            template, origin = self.find_template(template_name, template_dirs)
-            if not hasattr(template, 'render'):
                 try:
-                    template = get_template_from_string(template, origin, template_name)
+                    with compiling(loader, template_name):
+                        template = get_template_from_string(template, origin, template_name)
                 except TemplateDoesNotExist:
                     # If compiling the template we found raises TemplateDoesNotExist,
                     # back off to returning the source and display name for the template
                     # we were asked to load. This allows for correct identification (later)
                     # of the actual template that does not exist.
                     return template, origin
-            self.template_cache[key] = template
-        return self.template_cache[key], None
+                if shared_key is not None:
+                    self.shared_templates[shared_key] = template
+        self.template_cache.set(key, template, size)
+        self.origins[key] = (loader, display_name)
+        self.add_dependencies(key, template)
+        if self.revalidate_interval is not None:
+            self.add_file_stat(key, display_name)
+        return template, None
+
+    def shared_stats(self):
+        """
+        Returns the number of keys of the cache, the number of different
+        templates, the number of keys that share the template of other key and
+        the characters of source that these keys did not compile again.
+        """
+        seen = set()
+        keys = shared = saved = 0
+        for key in self.template_cache:
+            template = self.template_cache.peek(key)
+            if template is None:
+                continue
+            keys += 1
+            if id(template) in seen:
+                shared += 1
+                saved += self.template_cache.sizes.get(key, 0)
+            else:
+                seen.add(id(template))
+        return {'keys': keys, 'templates': len(seen), 'shared': shared, 'saved': saved}
+
+    def get_prefetch_pool(self):
+        """
+        Returns the pool of threads of this process. The threads of a pool
+        created before a fork (e.g. warming the cache) do not exist in the
+        forked process, so it creates other pool.
+        """
+        pid = os.getpid()
+        with self.compile_locks_lock:
+            if self.prefetch_pool is None or self.prefetch_pool[0] != pid:
+                self.prefetch_pool = (pid, ThreadPool(self.prefetch_threads))
+        return self.prefetch_pool[1]
+
+    def fetch_sources(self, name, dirs, loaders):
+        """
+        Looks for a template name in several loaders at the same time.
+        Returns the list of (template, loader, display_name) of the loaders
+        that have it, in the order of the loaders.
+        """
+        def fetch(loader):
+            try:
+                return load_from_loaders((loader,), name, dirs, sources=True)
+            except Exception:
+                # The errors are raised when the template is loaded
+                return None
+            finally:
+                # The loaders of a database (e.g. dbtemplates) open a
+                # connection in this thread
+                for connection in connections.all():
+                    connection.close()
+        loaders = [loader for loader in loaders if not isinstance(loader, CachedLoader)]
+        sources = self.get_prefetch_pool().map(fetch, loaders)
+        return [source for source in sources if source is not None]
+
+    def get_constant_parent(self, name, template, loader):
+        """
+        Returns the parent name of a template that extends a constant name and
+        the loader to skip (only if it smart_extends itself), or None.
+        """
+        node = get_first_node(getattr(template, 'nodelist', ()))
+        if not isinstance(node, ExtendsNode) or not is_constant(node.parent_name):
+            return None
+        parent_name = node.parent_name.var
+        if isinstance(node, SmartExtendsNode) and parent_name == name:
+            return (parent_name, loader)
+        return (parent_name, None)
+
+    def get_candidate_loaders(self, skip_loader=None):
+        if skip_loader is None:
+            return self.loaders
+        return self.override_index.get_loaders(self.loaders, skip_loader)
+
+    def prefetch_parents(self, name, template, loader):
+        """
+        Loads the chain of parents with constant names of a template that was
+        just compiled. The sources of each parent name are fetched at the same
+        time from every loader that can have them, so the ancestors of a
+        template that smart_extends itself are fetched in one round. As
+        the extends tags do, the parents are loaded without directories.
+        """
+        parent = self.get_constant_parent(name, template, loader)
+        while parent is not None:
+            name, loader = parent
+            loaders = self.get_candidate_loaders(loader)
+            for source, source_loader, display_name in self.fetch_sources(name, None, loaders):
+                template = self.store_prefetched(name, loader, source, source_loader, display_name)
+                if template is None:
+                    return
+                loader = source_loader
+                parent = self.get_constant_parent(name, template, loader)
+                if parent != (name, loader):
+                    # It does not smart_extends itself, the parent has other name
+                    break
+            else:
+                return
+
+    def load_templates(self, names, errors=None):
+        """
+        Loads several templates (without directories) and their chains of
+        parents with constant names, level by level, so the loaders with a
+        load_template_sources method (see load_sources_from_loader) get the
+        names of each level in one call. Returns the number of templates
+        that were compiled. If errors is a dictionary, the exceptions of each
+        name are stored in it instead of raising them.
+        """
+        loaded = 0
+        pending = [(name, None) for name in names]
+        while pending:
+            pending = [(name, skip_loader) for name, skip_loader in set(pending)
+                       if self.get_skip_key(name, skip_loader) not in self.template_cache]
+            found = {}
+            for loader in self.loaders:
+                if isinstance(loader, CachedLoader):
+                    continue
+                requests = [(name, skip_loader) for name, skip_loader in pending
+                            if (name, skip_loader) not in found and
+                            loader in self.get_candidate_loaders(skip_loader)]
+                if not requests:
+                    continue
+                sources = load_sources_from_loader(loader, list(set([name for name, skip_loader in requests])),
+                                                   errors=errors)
+                for name, skip_loader in requests:
+                    if name in sources:
+                        found[(name, skip_loader)] = sources[name]
+            pending = []
+            for (name, skip_loader), (source, source_loader, display_name) in found.items():
+                try:
+                    template = self.store_prefetched(name, skip_loader, source, source_loader, display_name)
+                except Exception as e:
+                    if errors is not None:
+                        errors[name] = e
+                    elif not isinstance(e, TemplateSyntaxError):
+                        raise
+                    # It is raised again when the template is loaded
+                    continue
+                if template is not None:
+                    loaded += 1
+                    parent = self.get_constant_parent(name, template, source_loader)
+                    if parent is not None:
+                        pending.append(parent)
+        return loaded
+
+    def get_skip_key(self, name, skip_loader=None):
+        skip_template = None
+        if skip_loader is not None:
+            skip_template = LoaderOrigin(None, skip_loader, name, None)
+        return self.get_cache_key(name, None, skip_template)
+
+    def store_prefetched(self, name, skip_loader, source, loader, display_name):
+        """
+        Stores a prefetched template (without directories) and returns it, or
+        None if it is in the cache already or other thread is compiling it.
+        """
+        key = self.get_skip_key(name, skip_loader)
+        lock = self.get_compile_lock(key)
+        try:
+            # Without waiting, two threads prefetching each other's templates
+            # would wait forever
+            if not lock.acquire(False):
+                return None
+            try:
+                if key in self.template_cache:
+                    return None
+                origin = make_origin(display_name, loader, name, None)
+                template, origin = self.store_template(key, name, source, origin, loader, display_name)
+                if origin is not None:
+                    return None
+                return template
+            finally:
+                lock.release()
+        finally:
+            self.release_compile_lock(key)
+
+    def get_file_stat(self, path):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        return (stat.st_mtime, stat.st_size)
+
+    def add_file_stat(self, key, display_name):
+        if display_name and os.path.isabs(display_name):
+            stat = self.get_file_stat(display_name)
+            if stat is not None:
+                self.file_stats[key] = (display_name, stat)
+                self.file_checks[display_name] = time.time()
+
+    def file_changed(self, key):
+        """
+        Returns True if the file of a template changed, it only looks at the
+        file if it was not looked at in the last revalidate_interval seconds.
+        """
+        try:
+            path, stat = self.file_stats[key]
+        except KeyError:
+            return False
+        now = time.time()
+        if now - self.file_checks.get(path, 0) < self.revalidate_interval:
+            return False
+        self.file_checks[path] = now
+        return self.get_file_stat(path) != stat
+
+    def get_dependencies(self, key, template):
+        "Returns the names of the templates that a template depends on"
+        names = [key[0]]
+        node = get_first_node(getattr(template, 'nodelist', ()))
+        if isinstance(node, ExtendsNode) and is_constant(node.parent_name):
+            names.append(node.parent_name.var)
+        return names
+
+    def get_parent_key(self, key, template):
+        "Returns the key of the parent of a template if its name is a constant"
+        loader = self.origins.get(key, (None, None))[0]
+        parent = self.get_constant_parent(key[0], template, loader)
+        if parent is None:
+            return None
+        return self.get_skip_key(*parent)
+
+    def get_changed_template(self, key, template):
+        """
+        Returns the name of the first template of the chain of parents of a
+        template (this template included) whose file changed, or None. The
+        parents are looked at too because the nodes of a template can keep
+        them (see SMART_EXTENDS_FLATTEN and SMART_EXTENDS_CACHE_PARENTS).
+        """
+        seen = set()
+        while template is not None and key not in seen:
+            seen.add(key)
+            if self.file_changed(key):
+                return key[0]
+            key = self.get_parent_key(key, template)
+            if key is None:
+                return None
+            template = self.template_cache.peek(key)
+        return None
+
+    def add_dependencies(self, key, template):
+        with self.dependents_lock:
+            for name in self.get_dependencies(key, template):
+                self.dependents.setdefault(name, set()).add(key)
+
+    def forget(self, key, template):
+        """
+        Removes what the loader knows about a template discarded by the
+        template cache: its origin, its dependencies and its file.
+        """
+        with self.dependents_lock:
+            if key in self.template_cache:
+                # Other thread loaded it again
+                return
+            self.origins.pop(key, None)
+            for name in self.get_dependencies(key, template):
+                keys = self.dependents.get(name)
+                if keys is not None:
+                    keys.discard(key)
+                    if not keys:
+                        del self.dependents[name]
+            file_stat = self.file_stats.pop(key, None)
+            if file_stat is not None:
+                self.file_checks.pop(file_stat[0], None)
+
+    def invalidate(self, name):
+        """
+        Removes from the cache the templates with this name and the templates
+        that extend them, recursively. Returns the names of these templates.
+        """
+        names = [name]
+        invalidated = set()
+        with self.dependents_lock:
+            while names:
+                name = names.pop()
+                if name in invalidated:
+                    continue
+                invalidated.add(name)
+                for key in self.dependents.pop(name, ()):
+                    self.unshare(self.template_cache.peek(key))
+                    self.template_cache.delete(key)
+                    self.origins.pop(key, None)
+                    self.file_stats.pop(key, None)
+                    names.append(key[0])
+        return invalidated
+
+    def unshare(self, template):
+        "The next keys with the source of this template compile it again."
+        if template is None:
+            return
+        for shared_key, shared in list(self.shared_templates.items()):
+            if shared is template:
+                self.shared_templates.pop(shared_key, None)
+
+    def reset(self):
+        "Empty the template cache, the cache of misses and the cache of parents."
+        super(Loader, self).reset()
+        self.dirs_keys.clear()
+        self.shared_templates.clear()
+        with self.dependents_lock:
+            self.origins.clear()
+            self.dependents.clear()
+            self.file_stats.clear()
+            self.file_checks.clear()
+        reset_miss_cache()
+        invalidate_parent_cache()
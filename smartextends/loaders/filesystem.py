@@ -0,0 +1,117 @@
+# Copyright (c) 2010-2013 by Pablo Martin <goinnn@gmail.com>
+#
+# This software is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This software is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this software.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import posixpath
+import time
+
+from django.conf import settings
+from django.template.base import TemplateDoesNotExist
+from django.template.loader import BaseLoader
+from django.utils._os import safe_join
+
+from smartextends.loader import compiling
+
+
+def get_directory_template_names(template_dirs):
+    """
+    Returns the names of the files of some template directories. The
+    symbolic links are followed, as the filesystem loader of Django does,
+    but not the links to a directory that contains them (cycles).
+    """
+    names = []
+    for template_dir in template_dirs:
+        parents = {template_dir: frozenset([os.path.realpath(template_dir)])}
+        for dirpath, dirnames, filenames in os.walk(template_dir, followlinks=True):
+            seen = parents.pop(dirpath)
+            for dirname in list(dirnames):
+                path = os.path.join(dirpath, dirname)
+                realpath = os.path.realpath(path)
+                if realpath in seen:
+                    dirnames.remove(dirname)
+                else:
+                    parents[path] = seen | frozenset([realpath])
+            for filename in filenames:
+                path = os.path.relpath(os.path.join(dirpath, filename), template_dir)
+                names.append(path.replace(os.sep, '/'))
+    return names
+
+
+class Loader(BaseLoader):
+    """
+    Filesystem loader that knows the files of each template directory (an
+    index built the first time that the directory is used), so it only opens
+    the files that exist instead of trying every directory. The indexes are
+    built again every SMART_EXTENDS_INDEX_REFRESH_INTERVAL seconds (by
+    default never) or when refresh is called, until then the new files are
+    not found.
+
+    The smart_extends tags of the templates that it compiles know it without
+    TEMPLATE_DEBUG nor the patch of Django.
+    """
+    is_usable = True
+
+    def __init__(self, *args, **kwargs):
+        super(Loader, self).__init__(*args, **kwargs)
+        self.indexes = {}
+        self.refresh_interval = getattr(settings, 'SMART_EXTENDS_INDEX_REFRESH_INTERVAL', None)
+
+    def __call__(self, template_name, template_dirs=None):
+        # The smart_extends tags of the templates compiled here know their loader
+        with compiling(self.load_template_source, template_name):
+            return self.load_template(template_name, template_dirs)
+
+    def get_template_dirs(self):
+        return settings.TEMPLATE_DIRS
+
+    def get_index(self, template_dir):
+        index, built = self.indexes.get(template_dir, (None, None))
+        now = time.time()
+        if index is None or (self.refresh_interval is not None and now - built >= self.refresh_interval):
+            index = frozenset(get_directory_template_names([template_dir]))
+            self.indexes[template_dir] = (index, now)
+        return index
+
+    def refresh(self, template_dir=None):
+        "Discards the index of a template directory, or every index."
+        if template_dir is None:
+            self.indexes.clear()
+        else:
+            self.indexes.pop(template_dir, None)
+
+    def get_template_names(self):
+        names = set()
+        for template_dir in self.get_template_dirs():
+            names.update(self.get_index(template_dir))
+        return sorted(names)
+
+    def load_template_source(self, template_name, template_dirs=None):
+        name = posixpath.normpath(template_name)
+        for template_dir in template_dirs or self.get_template_dirs():
+            if name not in self.get_index(template_dir):
+                continue
+            try:
+                filepath = safe_join(template_dir, template_name)
+            except ValueError:
+                # The joined path was located outside of template_dir.
+                continue
+            try:
+                with open(filepath, 'rb') as fp:
+                    return (fp.read().decode(settings.FILE_CHARSET), filepath)
+            except IOError:
+                # The file was removed after building the index
+                self.refresh(template_dir)
+        raise TemplateDoesNotExist(template_name)
+    load_template_source.is_usable = True
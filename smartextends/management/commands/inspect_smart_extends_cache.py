@@ -0,0 +1,59 @@
+# Copyright (c) 2010-2013 by Pablo Martin <goinnn@gmail.com>
+#
+# This software is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This software is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this software.  If not, see <http://www.gnu.org/licenses/>.
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from smartextends.memory import get_cached_loaders, inspect_template_cache, total_template_cache_size
+from smartextends.warmup import warm_template_cache
+
+
+class Command(BaseCommand):
+    args = '<template_name template_name ...>'
+    help = ('Loads the templates (by default every template of the template loaders) as '
+            'warm_smart_extends_cache and shows the estimated size, the nodes and the chain of '
+            'parents of every template of smartextends.loaders.cached.Loader, sorted by size. '
+            'To inspect the cache of a running process call smartextends.memory.inspect_template_cache.')
+    option_list = BaseCommand.option_list + (
+        make_option('--limit', type='int', dest='limit', default=None,
+                    help='Number of templates to show (by default all of them)'),
+    )
+
+    def handle(self, *args, **options):
+        verbosity = int(options.get('verbosity', 1))
+        loaded, errors = warm_template_cache(args or None)
+        for name in sorted(errors):
+            self.stderr.write('Error loading %s: %s' % (name, errors[name]))
+        cached_loaders = get_cached_loaders()
+        if not cached_loaders:
+            self.stderr.write('There is not a smartextends.loaders.cached.Loader in TEMPLATE_LOADERS')
+            return
+        for cached_loader in cached_loaders:
+            entries = inspect_template_cache(cached_loader)
+            for entry in entries[:options.get('limit')]:
+                name, dirs_key, skip_key = entry['key']
+                key = name
+                if dirs_key is not None:
+                    key += ' dirs=%s' % dirs_key[:8]
+                if skip_key is not None:
+                    key += ' skip=%s' % skip_key.__name__
+                self.stdout.write('%10.1f KiB %6d nodes %2d levels %s%s' %
+                                  (entry['size'] / 1024.0, entry['nodes'], entry['depth'], key,
+                                   entry['shared'] > 1 and ' (shared by %d keys)' % entry['shared'] or ''))
+                if verbosity >= 2:
+                    for loader_name, display_name in entry['levels']:
+                        self.stdout.write('    %s: %s' % (loader_name, display_name))
+            self.stdout.write('%d keys, %.1f KiB' % (len(entries), total_template_cache_size(entries) / 1024.0))
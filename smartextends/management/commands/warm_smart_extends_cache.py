@@ -0,0 +1,42 @@
+# Copyright (c) 2010-2013 by Pablo Martin <goinnn@gmail.com>
+#
+# This software is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This software is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this software.  If not, see <http://www.gnu.org/licenses/>.
+
+import time
+
+from django.core.management.base import BaseCommand
+
+from smartextends.warmup import warm_template_cache
+
+
+class Command(BaseCommand):
+    args = '<template_name template_name ...>'
+    help = ('Loads the templates (by default every template of the template loaders) and '
+            'the parents of their smart_extends tags. It shows the time and the errors, '
+            'to share the templates between the workers call '
+            'smartextends.warmup.warm_template_cache before forking them.')
+
+    def handle(self, *args, **options):
+        verbosity = int(options.get('verbosity', 1))
+        start = time.time()
+        loaded, errors = warm_template_cache(args or None)
+        elapsed = time.time() - start
+        if verbosity >= 2:
+            for name in loaded:
+                self.stdout.write('Loaded %s' % name)
+        for name in sorted(errors):
+            self.stderr.write('Error loading %s: %s' % (name, errors[name]))
+        if verbosity >= 1:
+            self.stdout.write('Loaded %d templates (%d errors) in %.3f seconds' %
+                              (len(loaded), len(errors), elapsed))
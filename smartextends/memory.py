@@ -0,0 +1,152 @@
+# Copyright (c) 2010-2013 by Pablo Martin <goinnn@gmail.com>
+#
+# This software is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This software is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this software.  If not, see <http://www.gnu.org/licenses/>.
+
+import sys
+import threading
+import types
+
+from django.template.base import Node, Template
+from django.template.loader import BaseLoader
+from django.template.loader_tags import ExtendsNode
+from django.utils import six
+
+from smartextends.loader import get_loader_key, get_template_source_loaders
+from smartextends.templatetags.smart_extends_tags import SmartExtendsNode, get_first_node, is_constant
+
+# The objects that are shared by every template, they are not counted
+SHARED_TYPES = (type, types.ModuleType, types.FunctionType, types.BuiltinFunctionType, types.MethodType,
+                BaseLoader, type(threading.Lock()))
+if not six.PY3:
+    SHARED_TYPES += (types.ClassType,)
+
+# The attributes of SmartExtendsNode with the nodes of its parents
+CHAIN_ATTRIBUTES = ('flattened', 'compiled', 'cached_parent')
+
+
+def get_referents(obj):
+    if isinstance(obj, dict):
+        return list(obj.keys()) + list(obj.values())
+    if isinstance(obj, (list, tuple, set, frozenset)):
+        return list(obj)
+    referents = []
+    if hasattr(obj, '__dict__'):
+        referents.append(obj.__dict__)
+    for slot in getattr(type(obj), '__slots__', ()):
+        if hasattr(obj, slot):
+            referents.append(getattr(obj, slot))
+    return referents
+
+
+def get_template_size(template):
+    """
+    Returns the estimated size in bytes (sys.getsizeof of the objects that it
+    references) and the number of nodes of a compiled template. The classes,
+    functions, loaders and other templates (e.g. the parents kept by the
+    smart_extends nodes, their flattened chains and their compiled
+    functions) are not counted.
+    """
+    seen = set()
+    size = nodes = 0
+    pending = [template]
+    while pending:
+        obj = pending.pop()
+        if id(obj) in seen or isinstance(obj, SHARED_TYPES):
+            continue
+        if isinstance(obj, Template) and obj is not template:
+            continue
+        seen.add(id(obj))
+        size += sys.getsizeof(obj)
+        if isinstance(obj, SmartExtendsNode):
+            for name in CHAIN_ATTRIBUTES:
+                value = getattr(obj, name, None)
+                if value is not None:
+                    seen.add(id(value))
+        if isinstance(obj, Node):
+            nodes += 1
+        if not isinstance(obj, six.string_types + (six.binary_type,) + six.integer_types + (float,)):
+            pending.extend(get_referents(obj))
+    return size, nodes
+
+
+def get_loader_name(loader):
+    key = get_loader_key(loader)
+    return '%s.%s' % (key.__module__, key.__name__)
+
+
+def get_chain(cached_loader, key, template):
+    """
+    Returns the (loader name, display name) of every level of the chain of
+    parents of a template, while its parents have constant names and they are
+    in the cache. It stops when a key repeats (a chain that loops).
+    """
+    levels = []
+    seen = set()
+    while template is not None and key not in seen:
+        seen.add(key)
+        loader, display_name = cached_loader.origins.get(key, (None, None))
+        levels.append((loader and get_loader_name(loader), display_name))
+        node = get_first_node(getattr(template, 'nodelist', ()))
+        if not isinstance(node, ExtendsNode) or not is_constant(node.parent_name) or loader is None:
+            break
+        parent_name = node.parent_name.var
+        if isinstance(node, SmartExtendsNode) and parent_name == key[0]:
+            key = cached_loader.get_skip_key(parent_name, loader)
+        else:
+            key = cached_loader.get_skip_key(parent_name)
+        template = cached_loader.template_cache.peek(key)
+    return levels
+
+
+def inspect_template_cache(cached_loader):
+    """
+    Returns a dictionary for every key of the template cache of a
+    smartextends.loaders.cached.Loader, sorted by size: key, size (estimated
+    bytes), nodes, depth (levels of its chain of parents), levels (loader and
+    display name of each level) and shared (number of keys with this compiled
+    template, whose size is only counted once in total_template_cache_size).
+    """
+    sizes = {}
+    templates = []
+    for key in cached_loader.template_cache:
+        template = cached_loader.template_cache.peek(key)
+        if template is None:
+            continue
+        if id(template) not in sizes:
+            sizes[id(template)] = [get_template_size(template), 0]
+        sizes[id(template)][1] += 1
+        templates.append((key, template))
+    entries = []
+    for key, template in templates:
+        (size, nodes), shared = sizes[id(template)]
+        levels = get_chain(cached_loader, key, template)
+        entries.append({'key': key,
+                        'size': size,
+                        'nodes': nodes,
+                        'depth': len(levels),
+                        'levels': levels,
+                        'shared': shared})
+    entries.sort(key=lambda entry: entry['size'], reverse=True)
+    return entries
+
+
+def get_cached_loaders():
+    "Returns the template loaders that are smartextends.loaders.cached.Loader"
+    from smartextends.loaders.cached import Loader
+    return [loader for loader in get_template_source_loaders() if isinstance(loader, Loader)]
+
+
+def total_template_cache_size(entries):
+    "The size of the entries of inspect_template_cache, once for each template"
+    return int(round(sum([entry['size'] / float(entry['shared']) for entry in entries])))
@@ -0,0 +1,81 @@
+# Copyright (c) 2010-2013 by Pablo Martin <goinnn@gmail.com>
+#
+# This software is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This software is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this software.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+import threading
+
+from django.conf import settings
+
+from smartextends import stats
+
+logger = logging.getLogger('smartextends.profile')
+
+_local = threading.local()
+
+
+def record_event(event):
+    "Hook that adds the events to the profile of the current request."
+    profile = getattr(_local, 'profile', None)
+    if profile is None:
+        return
+    profile['loader_calls'] += len(event['tried'])
+    profile['misses'] += event['misses']
+    if event['cache'] == 'hit':
+        profile['cache_hits'] += 1
+    elif event['cache'] == 'miss':
+        profile['cache_misses'] += 1
+    if not event['nested']:
+        # The time of the nested resolutions is in the time of their callers
+        profile['resolutions'] += 1
+        profile['time'] += event['elapsed']
+        if event['smart_extends']:
+            profile['smart_extends'] += 1
+
+
+def format_profile(profile):
+    return ('resolutions=%(resolutions)d; smart_extends=%(smart_extends)d; '
+            'loader_calls=%(loader_calls)d; misses=%(misses)d; cache_hits=%(cache_hits)d; '
+            'cache_misses=%(cache_misses)d; time=%(time_ms).3fms' %
+            dict(profile, time_ms=profile['time'] * 1000))
+
+
+class ProfileMiddleware(object):
+    """
+    Profiles the template resolutions of each request: resolutions, the ones
+    of smart_extends, calls and misses of the loaders, hits and misses of
+    the cached loader and time spent looking for (and compiling, in the
+    cached loader) templates. The profile is sent in the response header
+    SMART_EXTENDS_PROFILE_HEADER (by default X-Smart-Extends-Profile, None
+    to disable it) and logged (smartextends.profile logger, debug level).
+    """
+
+    def __init__(self):
+        stats.register_hook(record_event)
+
+    def process_request(self, request):
+        _local.profile = {'resolutions': 0, 'smart_extends': 0, 'loader_calls': 0,
+                          'misses': 0, 'cache_hits': 0, 'cache_misses': 0, 'time': 0.0}
+
+    def process_response(self, request, response):
+        profile = getattr(_local, 'profile', None)
+        if profile is None:
+            return response
+        _local.profile = None
+        request.smart_extends_profile = profile
+        header = getattr(settings, 'SMART_EXTENDS_PROFILE_HEADER', 'X-Smart-Extends-Profile')
+        if header:
+            response[header] = format_profile(profile)
+        logger.debug('%s %s', request.path, format_profile(profile))
+        return response
@@ -1 +1,38 @@
-# Create your models here.
+# Copyright (c) 2010-2013 by Pablo Martin <goinnn@gmail.com>
+#
+# This software is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This software is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this software.  If not, see <http://www.gnu.org/licenses/>.
+
+from django.conf import settings
+from django.db.models.signals import post_delete, post_save
+
+from smartextends.loader import invalidate_template
+
+
+def invalidate_instance_template(sender, instance, **kwargs):
+    """
+    Invalidates the template of an instance of the models of the
+    SMART_EXTENDS_INVALIDATION_MODELS setting, a sequence of tuples
+    ('app_label.ModelName', 'field with the template name').
+    """
+    invalidation_models = getattr(settings, 'SMART_EXTENDS_INVALIDATION_MODELS', None)
+    if not invalidation_models:
+        return
+    model = '%s.%s' % (sender._meta.app_label, sender._meta.object_name)
+    for model_path, name_field in invalidation_models:
+        if model_path == model:
+            invalidate_template(getattr(instance, name_field))
+
+
+post_save.connect(invalidate_instance_template)
+post_delete.connect(invalidate_instance_template)
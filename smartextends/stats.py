@@ -0,0 +1,152 @@
+# Copyright (c) 2010-2013 by Pablo Martin <goinnn@gmail.com>
+#
+# This software is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This software is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this software.  If not, see <http://www.gnu.org/licenses/>.
+
+import threading
+import time
+
+hooks = []
+_local = threading.local()
+
+# Upper bounds (in milliseconds) of the buckets of the histograms of Statistics
+HISTOGRAM_BOUNDS = (0.1, 0.5, 1, 5, 10, 50, 100, None)
+
+
+def register_hook(hook):
+    """
+    Registers a callable that is called with an event (a dictionary) for
+    each resolution of a template (see make_event).
+    """
+    if hook not in hooks:
+        hooks.append(hook)
+
+
+def unregister_hook(hook):
+    if hook in hooks:
+        hooks.remove(hook)
+
+
+def start():
+    """
+    Returns the start time of a resolution, or None if there are not hooks,
+    so the resolutions are not measured without hooks. Every start must be
+    followed by a make_event.
+    """
+    if hooks:
+        _local.depth = getattr(_local, 'depth', 0) + 1
+        return time.time()
+    return None
+
+
+def make_event(source, name, start, skipped=(), tried=(), found=None, cache=None,
+               smart_extends=False):
+    """
+    Returns an event of a resolution: the source of the event ('find_template'
+    or 'cached_loader'), the template name, the keys of the loaders skipped
+    and tried (see smartextends.loader.get_loader_key), the number of misses,
+    the key of the loader that found the template (None if it was not
+    found), the result of the cache ('hit', 'miss' or None), the elapsed
+    time in seconds, if it skipped the template of a smart_extends and if
+    it is nested in other resolution (e.g. the cached loader called by
+    find_template).
+    """
+    _local.depth -= 1
+    misses = len(tried)
+    if found is not None and misses:
+        misses -= 1
+    return {'source': source,
+            'name': name,
+            'skipped': list(skipped),
+            'tried': list(tried),
+            'misses': misses,
+            'found': found,
+            'cache': cache,
+            'elapsed': time.time() - start,
+            'smart_extends': smart_extends,
+            'nested': _local.depth > 0}
+
+
+def emit(event):
+    for hook in list(hooks):
+        hook(event)
+
+
+class Statistics(object):
+    """
+    Hook that aggregates the events by source and template name: number of
+    resolutions, misses of the loaders, hits and misses of the cache, not
+    found templates, total and maximum time, and a histogram of the times
+    (see HISTOGRAM_BOUNDS). To use it::
+
+        from smartextends.stats import register_hook, statistics
+        register_hook(statistics)
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.data = {}
+
+    def __call__(self, event):
+        elapsed = event['elapsed']
+        milliseconds = elapsed * 1000
+        bucket = len(HISTOGRAM_BOUNDS) - 1
+        for i, bound in enumerate(HISTOGRAM_BOUNDS[:-1]):
+            if milliseconds <= bound:
+                bucket = i
+                break
+        key = (event['source'], event['name'])
+        with self.lock:
+            counters = self.data.get(key)
+            if counters is None:
+                counters = self.data[key] = {'count': 0, 'misses': 0, 'not_found': 0,
+                                             'cache_hits': 0, 'cache_misses': 0,
+                                             'time': 0.0, 'max_time': 0.0,
+                                             'histogram': [0] * len(HISTOGRAM_BOUNDS)}
+            counters['count'] += 1
+            counters['misses'] += event['misses']
+            if event['found'] is None:
+                counters['not_found'] += 1
+            if event['cache'] == 'hit':
+                counters['cache_hits'] += 1
+            elif event['cache'] == 'miss':
+                counters['cache_misses'] += 1
+            counters['time'] += elapsed
+            counters['max_time'] = max(counters['max_time'], elapsed)
+            counters['histogram'][bucket] += 1
+
+    def get_stats(self, source=None):
+        """
+        Returns a dictionary {(source, name): counters}, only of a source
+        if it is given.
+        """
+        with self.lock:
+            return dict((key, dict(counters, histogram=list(counters['histogram'])))
+                        for key, counters in self.data.items()
+                        if source is None or key[0] == source)
+
+    def top(self, number=10, source=None):
+        """
+        Returns the (source, name) and counters of the templates that took
+        more time to be resolved, sorted by their total time.
+        """
+        items = list(self.get_stats(source).items())
+        items.sort(key=lambda item: item[1]['time'], reverse=True)
+        return items[:number]
+
+    def reset(self):
+        with self.lock:
+            self.data.clear()
+
+
+statistics = Statistics()
@@ -0,0 +1,138 @@
+# Copyright (c) 2010-2013 by Pablo Martin <goinnn@gmail.com>
+#
+# This software is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This software is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this software.  If not, see <http://www.gnu.org/licenses/>.
+
+from django.conf import settings
+from django.template import Context
+from django.template.base import Node, NodeList
+from django.template.loader import get_template, select_template
+from django.template.loader_tags import BLOCK_CONTEXT_KEY, BlockNode, ExtendsNode
+from django.utils.encoding import force_text
+
+from smartextends.templatetags.smart_extends_tags import SmartExtendsNode, get_extends_template
+
+
+def stream_nodelist(nodelist, context):
+    """
+    Yields the output of a nodelist node by node. The extends, smart_extends
+    and block nodes yield the output of their own nodes, the other nodes
+    (for example a block inside an if tag) are rendered at once.
+    """
+    if type(nodelist).render != NodeList.render:
+        # For example the nodelist of a cached block
+        yield force_text(nodelist.render(context))
+        return
+    for node in nodelist:
+        if isinstance(node, ExtendsNode):
+            for bit in stream_extends(node, context):
+                yield bit
+        elif isinstance(node, BlockNode):
+            for bit in stream_block(node, context):
+                yield bit
+        elif isinstance(node, Node):
+            yield force_text(nodelist.render_node(node, context))
+        else:
+            yield force_text(node)
+
+
+def stream_extends(node, context):
+    """
+    Yields the output of the parent (or of the root of the flattened chain)
+    of an extends or smart_extends node. The compiled chains (see
+    SMART_EXTENDS_COMPILE) are streamed as the flattened ones.
+    """
+    if isinstance(node, SmartExtendsNode):
+        template = node.get_render_template(context)
+    else:
+        template = get_extends_template(node, context)
+    return stream_nodelist(template.nodelist, context)
+
+
+def stream_block(node, context):
+    """
+    The same as BlockNode.render, but yielding the output of the block
+    """
+    block_context = context.render_context.get(BLOCK_CONTEXT_KEY)
+    context.push()
+    if block_context is None:
+        context['block'] = node
+        for bit in stream_nodelist(node.nodelist, context):
+            yield bit
+    else:
+        push = block = block_context.pop(node.name)
+        if block is None:
+            block = node
+        block = BlockNode(block.name, block.nodelist)
+        block.context = context
+        context['block'] = block
+        for bit in stream_nodelist(block.nodelist, context):
+            yield bit
+        if push is not None:
+            block_context.push(node.name, push)
+    context.pop()
+
+
+def stream_template(template, context, chunk_size=None):
+    """
+    Renders a template as a generator of strings of at least chunk_size
+    characters (by default SMART_EXTENDS_STREAM_CHUNK_SIZE) but the last one.
+    """
+    if chunk_size is None:
+        chunk_size = getattr(settings, 'SMART_EXTENDS_STREAM_CHUNK_SIZE', 4096)
+    context.render_context.push()
+    try:
+        bits = []
+        size = 0
+        for bit in stream_nodelist(template.nodelist, context):
+            bits.append(bit)
+            size += len(bit)
+            if size >= chunk_size:
+                yield ''.join(bits)
+                bits = []
+                size = 0
+        if bits:
+            yield ''.join(bits)
+    finally:
+        context.render_context.pop()
+
+
+def stream_and_pop(chunks, context):
+    "Yields the chunks of a stream and pops the context when it ends"
+    try:
+        for chunk in chunks:
+            yield chunk
+    finally:
+        context.pop()
+
+
+def render_to_stream(template_name, dictionary=None, context_instance=None, chunk_size=None):
+    """
+    The same as render_to_string, but it returns a generator of strings, for
+    example for the StreamingHttpResponse of Django 1.5::
+
+        return StreamingHttpResponse(render_to_stream('admin/change_form.html', context))
+
+    The template is loaded before returning, so TemplateDoesNotExist is
+    raised by the view, before the response starts. The dictionary is
+    popped from context_instance when the generator ends.
+    """
+    dictionary = dictionary or {}
+    if isinstance(template_name, (list, tuple)):
+        template = select_template(template_name)
+    else:
+        template = get_template(template_name)
+    if not context_instance:
+        return stream_template(template, Context(dictionary), chunk_size)
+    context_instance.update(dictionary)
+    return stream_and_pop(stream_template(template, context_instance, chunk_size), context_instance)
@@ -16,20 +16,197 @@
 from django.template import TemplateSyntaxError
 from django.template import Library
 from django.conf import settings
-from django.template.base import Variable
-from django.template.loader_tags import ExtendsNode
+from django.template.base import TOKEN_BLOCK, TextNode, Variable
+from django.template.loader_tags import BLOCK_CONTEXT_KEY, BlockContext, BlockNode, ExtendsNode, do_block
+from django.utils import six
 
-from smartextends.loader import get_template
+from smartextends.block_cache import CachedNodeList, get_origin_key, get_tokens_key
+from smartextends.compiler import compile_chain
+from smartextends.loader import (get_cached_template, get_compiling_origin, get_loader_key,
+                                 get_parent_cache_generation, get_template)
 
 register = Library()
 
 
+class ExtendsRecursionError(TemplateSyntaxError):
+    "A template extends a template of its chain of parents"
+    pass
+
+
+def is_constant(filter_expression):
+    """
+    Returns True if the filter expression is a string literal without filters
+    """
+    return not filter_expression.filters and not isinstance(filter_expression.var, Variable)
+
+
+def get_first_node(nodelist):
+    for node in nodelist:
+        if not isinstance(node, TextNode):
+            return node
+    return None
+
+
+def get_extends_template(node, context):
+    """
+    Does what ExtendsNode.render does before rendering the parent: adds the
+    blocks of the template to the block context. Returns the parent.
+    """
+    compiled_parent = node.get_parent(context)
+    if BLOCK_CONTEXT_KEY not in context.render_context:
+        context.render_context[BLOCK_CONTEXT_KEY] = BlockContext()
+    block_context = context.render_context[BLOCK_CONTEXT_KEY]
+    block_context.add_blocks(node.blocks)
+    # If the parent does not extend other template it is the root, and its
+    # blocks are added too
+    first_node = get_first_node(compiled_parent.nodelist)
+    if first_node is not None and not isinstance(first_node, ExtendsNode):
+        block_context.add_blocks(dict([(n.name, n) for n in
+                                       compiled_parent.nodelist.get_nodes_by_type(BlockNode)]))
+    return compiled_parent
+
+
 class SmartExtendsNode(ExtendsNode):
 
+    def __init__(self, nodelist, parent_name, template_dirs=None, flatten=False, cache_parent=False,
+                 compile_python=False, origin=None):
+        super(SmartExtendsNode, self).__init__(nodelist, parent_name, template_dirs)
+        self.origin = origin
+        self.flatten = flatten or compile_python
+        self.flattened = None
+        self.compile_python = compile_python
+        self.compiled = None
+        self.cache_parent = cache_parent and is_constant(parent_name)
+        self.cached_parent = None
+
     def __repr__(self):
         return '<SmartExtendsNode: extends %s>' % self.parent_name.token
 
+    def get_flattened(self, context):
+        """
+        Resolves the chain of parents of this template, returns a tuple with
+        the root template and a dictionary with the block nodes of every
+        level by name (from the root to this template, as BlockContext stores
+        them). Returns None if the name of any parent is not a constant.
+        Raises ExtendsRecursionError if the chain loops.
+        """
+        levels = [self.blocks]
+        node = self
+        seen = set()
+        while True:
+            if not is_constant(node.parent_name):
+                return None
+            # A level gets the same parent if it has the same name and skips
+            # the same loader (only smart_extends skips it)
+            skip_key = None
+            if isinstance(node, SmartExtendsNode):
+                skip_key = get_loader_key(getattr(node.get_origin(), 'loader', None))
+            parent_key = (node.parent_name.var, skip_key)
+            if parent_key in seen:
+                raise ExtendsRecursionError("The chain of parents of %s extends %s recursively" %
+                                            (self.parent_name.var, node.parent_name.var))
+            seen.add(parent_key)
+            compiled_parent = node.get_parent(context)
+            node = get_first_node(compiled_parent.nodelist)
+            if not isinstance(node, ExtendsNode):
+                if node is not None:
+                    levels.append(dict([(n.name, n) for n in
+                                        compiled_parent.nodelist.get_nodes_by_type(BlockNode)]))
+                break
+            levels.append(node.blocks)
+        blocks = {}
+        for level in levels:
+            for name, block in six.iteritems(level):
+                blocks.setdefault(name, []).insert(0, block)
+        return compiled_parent, blocks
+
+    def get_flattened_chain(self, context):
+        """
+        Returns the flattened chain of parents (see get_flattened), resolving
+        it only the first time and when the cache of parents is invalidated.
+        Returns None if it can not be flattened.
+        """
+        generation = get_parent_cache_generation()
+        flattened = self.flattened
+        if flattened is None or flattened[0] != generation:
+            flattened = self.get_flattened(context)
+            if flattened is None:
+                self.flatten = False
+                return None
+            flattened = self.flattened = (generation,) + flattened
+        return flattened[1:]
+
+    def render(self, context):
+        flattened = self.flatten and self.get_flattened_chain(context)
+        if not flattened:
+            return super(SmartExtendsNode, self).render(context)
+        if BLOCK_CONTEXT_KEY not in context.render_context and self.compile_python:
+            # Only if no template extends this one, the compiled function
+            # knows the blocks of this chain only
+            return self.render_compiled(context, *flattened)
+        return self.get_render_template(context, flattened)._render(context)
+
+    def get_render_template(self, context, flattened=None):
+        """
+        Adds the blocks of this template (and of its chain of parents, if it
+        is flattened) to the block context and returns the template that has
+        to be rendered, the parent or the root of the chain.
+        """
+        if flattened is None:
+            flattened = self.flatten and self.get_flattened_chain(context)
+        if not flattened:
+            return get_extends_template(self, context)
+        root, blocks = flattened
+        if BLOCK_CONTEXT_KEY not in context.render_context:
+            context.render_context[BLOCK_CONTEXT_KEY] = BlockContext()
+        block_context = context.render_context[BLOCK_CONTEXT_KEY]
+        # The blocks of the templates that extend this one go after ours
+        for name, chain in six.iteritems(blocks):
+            block_context.blocks[name] = chain + block_context.blocks.get(name, [])
+        return root
+
+    def get_compiled(self, root, blocks):
+        """
+        Returns the function that renders the flattened chain (see
+        smartextends.compiler), compiling it the first time and when the
+        chain changes.
+        """
+        flattened = self.flattened
+        compiled = self.compiled
+        if compiled is None or compiled[0] is not flattened:
+            compiled = self.compiled = (flattened, compile_chain(root, blocks))
+        return compiled[1]
+
+    def render_compiled(self, context, root, blocks):
+        block_context = context.render_context[BLOCK_CONTEXT_KEY] = BlockContext()
+        for name, chain in six.iteritems(blocks):
+            block_context.blocks[name] = list(chain)
+        return self.get_compiled(root, blocks)(context, block_context)
+
+    def get_origin(self):
+        """
+        Returns the origin of the template of this node: the origin of its
+        source (with TEMPLATE_DEBUG or the patch of Django) if it knows the
+        loader, else the origin that smartextends was loading when the node
+        was compiled (see smartextends.loader.compiling).
+        """
+        source = getattr(self, 'source', None)
+        if source is not None and getattr(source[0], 'loader', None) is not None:
+            return source[0]
+        if self.origin is not None:
+            return self.origin
+        if source is None:
+            raise TemplateSyntaxError("The loader of a template with smart_extends is unknown, load it with "
+                                      "smartextends.loaders.cached.Loader, the loaders of smartextends, "
+                                      "TEMPLATE_DEBUG or the patch of Django")
+        return source[0]
+
     def get_parent(self, context):
+        if self.cache_parent:
+            generation = get_parent_cache_generation()
+            cached_parent = self.cached_parent
+            if cached_parent is not None and cached_parent[0] == generation:
+                return cached_parent[1]
         parent = self.parent_name.resolve(context)
         if not parent:
             error_msg = "Invalid template name in 'extends' tag: %r." % parent
@@ -39,10 +216,128 @@ class SmartExtendsNode(ExtendsNode):
             raise TemplateSyntaxError(error_msg)
         if hasattr(parent, 'render'):
             return parent  # parent is a Template object
-        origin, source = self.source
+        origin = self.get_origin()
+        if self.cache_parent:
+            template = get_cached_template(parent, skip_template=origin)
+            self.cached_parent = (generation, template)
+            return template
         return get_template(parent, skip_template=origin)
 
 
+class LazyBlockNode(BlockNode):
+    """
+    A block whose content is parsed the first time that its nodelist is used
+    """
+
+    def __init__(self, name, tokens, parser_class, tags, filters):
+        self.name, self.parent = name, None
+        self.lazy = (tokens, parser_class, tags, filters)
+        self._nodelist = None
+
+    def __repr__(self):
+        if self._nodelist is None:
+            return "<Lazy Block Node: %s. Not parsed>" % self.name
+        return super(LazyBlockNode, self).__repr__()
+
+    def get_nodelist(self):
+        # Another thread can parse it meanwhile, the nodelist is set before
+        # removing the tokens
+        lazy = self.lazy
+        nodelist = self._nodelist
+        if nodelist is None:
+            tokens, parser_class, tags, filters = lazy
+            parser = parser_class(list(tokens))
+            parser.tags = dict(tags)
+            parser.filters = dict(filters)
+            nodelist = self._nodelist = parser.parse()
+            self.lazy = None
+        return nodelist
+
+    def set_nodelist(self, nodelist):
+        self._nodelist = nodelist
+        self.lazy = None
+
+    nodelist = property(get_nodelist, set_nodelist)
+
+    def get_nodes_by_type(self, nodetype):
+        if self._nodelist is None:
+            # There are not blocks nor extends tags in the tokens
+            return [self] if isinstance(self, nodetype) else []
+        return super(LazyBlockNode, self).get_nodes_by_type(nodetype)
+
+
+def get_block_end(tokens, bits):
+    """
+    Returns the position of the endblock token of a block without nested
+    blocks, extends or load tags, else None. The tokens of the comment tags
+    are skipped (the lexer gives the content of the verbatim tags as text).
+    The libraries of a load tag are used by the rest of the template, so
+    the block has to be parsed at once.
+    """
+    if len(bits) != 2:
+        return None
+    in_comment = False
+    for i, token in enumerate(tokens):
+        if token.token_type != TOKEN_BLOCK:
+            continue
+        if in_comment:
+            # As Parser.skip_past, the first endcomment closes it
+            in_comment = token.contents != 'endcomment'
+            continue
+        command = token.contents.split()[0] if token.contents else None
+        if command == 'comment':
+            in_comment = True
+            continue
+        if command in (None, 'block', 'cached_block', 'extends', 'load', 'smart_extends'):
+            return None
+        if command == 'endblock':
+            if token.contents in ('endblock', 'endblock %s' % bits[1]):
+                return i
+            return None
+    return None
+
+
+def do_lazy_block(parser, token):
+    """
+    The block tag inside the templates with smart_extends if
+    SMART_EXTENDS_LAZY_BLOCKS is True. The blocks without nested blocks keep
+    their tokens and they are parsed the first time that they are used.
+    """
+    bits = token.contents.split()
+    end = get_block_end(parser.tokens, bits)
+    if end is None:
+        return do_block(parser, token)
+    block_name = bits[1]
+    loaded_blocks = getattr(parser, '__loaded_blocks', None)
+    if loaded_blocks is None:
+        loaded_blocks = []
+        setattr(parser, '__loaded_blocks', loaded_blocks)
+    if block_name in loaded_blocks:
+        raise TemplateSyntaxError("'%s' tag with name '%s' appears more than once" % (bits[0], block_name))
+    loaded_blocks.append(block_name)
+    tokens = parser.tokens[:end]
+    del parser.tokens[:end + 1]
+    # The blocks share the copy of the libraries until a load tag changes them
+    # (see do_lazy_load)
+    libraries = getattr(parser, '_lazy_libraries', None)
+    if libraries is None:
+        libraries = parser._lazy_libraries = (dict(parser.tags), dict(parser.filters))
+    return LazyBlockNode(block_name, tokens, type(parser), libraries[0], libraries[1])
+
+
+def get_lazy_load(load):
+    """
+    Returns the load tag inside the templates with smart_extends if
+    SMART_EXTENDS_LAZY_BLOCKS is True: the next lazy blocks copy the
+    libraries of the parser again.
+    """
+    def do_lazy_load(parser, token):
+        node = load(parser, token)
+        parser._lazy_libraries = None
+        return node
+    return do_lazy_load
+
+
 def do_smart_extends(parser, token):
     """
     Signal that this template smart_extends a parent template.
@@ -51,17 +346,98 @@ def do_smart_extends(parser, token):
     This tag provides the possibility to extend to yourself without infinite
     recursion. It is possible for use a API function "find_template",
     that skip the invoke template
+
+    The tag keeps the loader and the name of its template (to skip it) if
+    smartextends is loading the template (see smartextends.loader.compiling),
+    else it uses the origin of its source, which only exists with
+    TEMPLATE_DEBUG or the patch of Django.
+
+    If SMART_EXTENDS_FLATTEN is True and the names of the parents are
+    constants, the chain of parents is resolved in the first render and the
+    next renders use it without looking for the parents again.
+
+    If SMART_EXTENDS_COMPILE is True (experimental), the flattened chain is
+    translated into a Python function that renders it.
+
+    If SMART_EXTENDS_CACHE_PARENTS is True and the name of the parent is a
+    constant, the parent template is kept in the node and in a cache shared
+    by the nodes, until smartextends.loader.invalidate_parent_cache is called.
+
+    If SMART_EXTENDS_LAZY_BLOCKS is True, the blocks without nested blocks
+    are parsed when they are rendered (see LazyBlockNode).
     """
+    # The template that is being compiled (before parsing the templates that it includes)
+    origin = get_compiling_origin(parser)
     bits = token.split_contents()
     if len(bits) != 2:
         raise TemplateSyntaxError("'%s' takes one argument" % bits[0])
     parent_name = parser.compile_filter(bits[1])
-    nodelist = parser.parse()
+    if getattr(settings, 'SMART_EXTENDS_LAZY_BLOCKS', False):
+        block, load = parser.tags['block'], parser.tags['load']
+        parser.tags['block'] = do_lazy_block
+        parser.tags['load'] = get_lazy_load(load)
+        try:
+            nodelist = parser.parse()
+        finally:
+            parser.tags['block'], parser.tags['load'] = block, load
+    else:
+        nodelist = parser.parse()
     if nodelist.get_nodes_by_type(SmartExtendsNode):
         raise TemplateSyntaxError("'%s' cannot appear more than once in the same template" % bits[0])
-    return SmartExtendsNode(nodelist, parent_name)
+    return SmartExtendsNode(nodelist, parent_name,
+                            flatten=getattr(settings, 'SMART_EXTENDS_FLATTEN', False),
+                            cache_parent=getattr(settings, 'SMART_EXTENDS_CACHE_PARENTS', False),
+                            compile_python=getattr(settings, 'SMART_EXTENDS_COMPILE', False),
+                            origin=origin)
+
+
+def do_cached_block(parser, token):
+    """
+    Define a block, like the block tag, whose output is cached. The cache
+    key depends on the content of the block and the values of the
+    variables given after the name of the block::
+
+        {% cached_block sidebar request.user.pk %}{{ block.super }}{% endcached_block %}
+
+    The block that overrides the others is the one that is cached, so in a
+    template that smart_extends other one a cached block with block.super
+    caches the output of the parent. The blocks of other templates nested in
+    a cached block do not change the cache key, the output is kept until it
+    is removed from the cache (see smartextends.block_cache).
+
+    The key depends on the template too (its loader and name), so the same
+    block in other template has other key. If the name of the parent is a
+    variable, add it to the variables of the tag.
+    """
+    # The template that is being compiled, else the origin of the token
+    # (with TEMPLATE_DEBUG or the patch of Django)
+    origin = get_compiling_origin(parser)
+    if origin is None and getattr(token, 'source', None):
+        origin = token.source[0]
+    bits = token.split_contents()
+    if len(bits) < 2:
+        raise TemplateSyntaxError("'%s' tag takes at least one argument" % bits[0])
+    block_name = bits[1]
+    # The same check of duplicated blocks of the block tag
+    loaded_blocks = getattr(parser, '__loaded_blocks', None)
+    if loaded_blocks is None:
+        loaded_blocks = []
+        setattr(parser, '__loaded_blocks', loaded_blocks)
+    if block_name in loaded_blocks:
+        raise TemplateSyntaxError("'%s' tag with name '%s' appears more than once" % (bits[0], block_name))
+    loaded_blocks.append(block_name)
+    vary_on = [parser.compile_filter(bit) for bit in bits[2:]]
+    tokens = list(parser.tokens)
+    nodelist = parser.parse(('endcached_block',))
+    tokens_key = get_tokens_key([token] + tokens[:len(tokens) - len(parser.tokens)])
+    endblock = parser.next_token()
+    acceptable_endblocks = ('endcached_block', 'endcached_block %s' % block_name)
+    if endblock.contents not in acceptable_endblocks:
+        parser.invalid_block_tag(endblock, 'endcached_block', acceptable_endblocks)
+    return BlockNode(block_name, CachedNodeList(nodelist, tokens_key, vary_on, get_origin_key(origin)))
 
 
 if getattr(settings, 'OVERWRITE_EXTENDS', False):
     register.tag('extends', do_smart_extends)
 register.tag('smart_extends', do_smart_extends)
+register.tag('cached_block', do_cached_block)
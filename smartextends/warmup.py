@@ -0,0 +1,120 @@
+# Copyright (c) 2010-2013 by Pablo Martin <goinnn@gmail.com>
+#
+# This software is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This software is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this software.  If not, see <http://www.gnu.org/licenses/>.
+
+from django.conf import settings
+from django.template import Context
+from django.template.loader import get_template
+from django.template.loader_tags import ExtendsNode
+from django.template.loaders.cached import Loader as CachedLoader
+
+from smartextends.loader import get_template_source_loaders
+from smartextends.loaders.filesystem import get_directory_template_names
+from smartextends.templatetags.smart_extends_tags import (ExtendsRecursionError, SmartExtendsNode, get_first_node,
+                                                          is_constant)
+
+
+def get_loader_template_names(loader):
+    """
+    Returns the names of the templates that a loader can find. The loaders
+    can define a get_template_names method, else only the filesystem, the
+    app_directories and the dbtemplates loaders are known.
+    """
+    if hasattr(loader, 'get_template_names'):
+        return list(loader.get_template_names())
+    if isinstance(loader, CachedLoader):
+        names = []
+        for cached_loader in loader.loaders:
+            names.extend(get_loader_template_names(cached_loader))
+        return names
+    module = getattr(loader, '__module__', None)
+    if module == 'django.template.loaders.filesystem':
+        return get_directory_template_names(settings.TEMPLATE_DIRS)
+    elif module == 'django.template.loaders.app_directories':
+        from django.template.loaders.app_directories import app_template_dirs
+        return get_directory_template_names(app_template_dirs)
+    elif module == 'dbtemplates.loader':
+        from dbtemplates.models import Template
+        return list(Template.objects.values_list('name', flat=True))
+    return []
+
+
+def get_template_names():
+    """
+    Returns the sorted names of the templates of every template loader
+    """
+    names = set()
+    for loader in get_template_source_loaders():
+        names.update(get_loader_template_names(loader))
+    return sorted(names)
+
+
+def warm_parents(template, context=None):
+    """
+    Loads the chain of parents with constant names of a template. If the
+    smart_extends tag flattens its chain, it is flattened too.
+    """
+    context = context or Context()
+    node = get_first_node(template.nodelist)
+    name = template.name
+    names = set([name])
+    while isinstance(node, ExtendsNode) and is_constant(node.parent_name):
+        parent_name = node.parent_name.var
+        if parent_name in names and not (isinstance(node, SmartExtendsNode) and parent_name == name):
+            # Only a smart_extends of its own name skips the template that
+            # has the node, else the chain loads a template of it again
+            raise ExtendsRecursionError("%s extends %s recursively" % (template.name, parent_name))
+        names.add(parent_name)
+        if isinstance(node, SmartExtendsNode) and node.flatten:
+            node.get_flattened_chain(context)
+        parent = node.get_parent(context)
+        name = parent_name
+        node = get_first_node(parent.nodelist)
+
+
+def warm_template_cache(names=None):
+    """
+    Loads the templates (by default every template of get_template_names)
+    and their parents, so they are compiled in the cache of
+    smartextends.loaders.cached.Loader. It is useful in a WSGI file that is
+    loaded before the workers are forked, so they share the templates.
+
+    The cached loader loads them level by level first (see its
+    load_templates method), the errors of this pass are replaced by the
+    result of loading each name.
+
+    Returns a list with the loaded names and a dictionary with the
+    exception of every template that could not be loaded.
+    """
+    if names is None:
+        names = get_template_names()
+    errors = {}
+    for loader in get_template_source_loaders():
+        if hasattr(loader, 'load_templates'):
+            # The loaders with a batch method get the names in one call
+            try:
+                loader.load_templates(names, errors)
+            except Exception as e:
+                for name in names:
+                    errors.setdefault(name, e)
+    loaded = []
+    for name in names:
+        try:
+            warm_parents(get_template(name))
+        except Exception as e:
+            errors[name] = e
+        else:
+            errors.pop(name, None)
+            loaded.append(name)
+    return loaded, errors